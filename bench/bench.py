@@ -0,0 +1,264 @@
+import sys
+import os
+import gc
+import json
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import aasm
+
+# Generates synthetic aasm programs and times the assembler on them.
+#
+# Every program is a tree of %include files. Each node has its own labels,
+# jumps to labels before and after the current statement, and data tables.
+# Every node includes common.asm, which has %pragma once and holds the
+# constants and a shared routine. Every node also includes repeat.asm,
+# which has no labels, so it is parsed again each time it is included.
+
+Ops = ["ADD", "SUB", "MUL", "DIV", "REM", "MOV", "AND", "OR", "XOR", "SHL", "SHR", "CMP"]
+Sizes = ["8", "16", "32", "64"]
+Jumps = ["JMP", "JC", "JZ", "JE", "JNE", "JG", "JGE", "JL", "JLE"]
+Simple = ["RET", "SEI", "SDI"]
+LabelEvery = 8 # Statements between two labels
+NoiseFloor = 0.02 # Timings under this many seconds are too noisy to flag
+
+def Reg(Rng):
+    return f"G{Rng.randrange(11)}"
+
+def Dst(Rng, Label):
+    Kind = Rng.randrange(6)
+    if Kind == 0:
+        return f"[{Reg(Rng)}]"
+    elif Kind == 1:
+        return f"[{Reg(Rng)}+{Rng.randrange(256)}]"
+    elif Kind == 2:
+        return f"[{Reg(Rng)}+{Reg(Rng)}]"
+    elif Kind == 3:
+        return f"[{Label}]"
+    elif Kind == 4:
+        return f"[{Label}+{Reg(Rng)}]"
+    return Reg(Rng)
+
+def Src(Rng, Label):
+    Kind = Rng.randrange(6)
+    if Kind == 0:
+        return str(Rng.randrange(1 << 16))
+    elif Kind == 1:
+        return f"0x{Rng.randrange(1 << 32):X}"
+    elif Kind == 2:
+        return f"BENCH_BASE + {Rng.randrange(64)} * BENCH_STRIDE"
+    elif Kind == 3:
+        return Label
+    elif Kind == 4:
+        return f"[{Label}+{Rng.randrange(64)}]"
+    return Dst(Rng, Label)
+
+def Statement(Rng, Label):
+    # One statement for every handler Parser.Parse dispatches to
+    Kind = Rng.random()
+    if Kind < 0.50:
+        return f"{Rng.choice(Ops)}{Rng.choice(Sizes)} {Dst(Rng, Label)}, {Src(Rng, Label)}"
+    elif Kind < 0.56:
+        return f"PUSH{Rng.choice(Sizes)} {Src(Rng, Label)}"
+    elif Kind < 0.62:
+        return f"POP{Rng.choice(Sizes)} {Dst(Rng, Label)}"
+    elif Kind < 0.65:
+        return f"NOT{Rng.choice(Sizes)} {Dst(Rng, Label)}"
+    elif Kind < 0.77:
+        return f"{Rng.choice(Jumps)} {'REL ' if Rng.random() < 0.2 else ''}{Label}"
+    elif Kind < 0.83:
+        return f"CALL {Label}"
+    elif Kind < 0.87:
+        return Rng.choice(Simple)
+    elif Kind < 0.89:
+        return f"INT {Rng.randrange(32)}"
+    elif Kind < 0.95:
+        Values = ", ".join(str(Rng.randrange(256)) for i in range(Rng.randrange(1, 9)))
+        return f"D{Rng.choice(Sizes)} {Values}"
+    elif Kind < 0.97:
+        return f"TIMES {Rng.randrange(1, 9)} D{Rng.choice(Sizes)} {Rng.randrange(256)}, {Label}"
+    return f"RES{Rng.choice(Sizes)} {Rng.randrange(1, 17)}"
+
+def Node(Rng, Prefix, Count, Children, Forward, TableSize, Root):
+    Lines = []
+    if Root:
+        Lines.append("ORG 0x10000")
+        Lines.append("    JMP BENCH_START")
+    Lines.append('%include "common.asm"')
+    Lines.append('%include "repeat.asm"')
+    Labels = (Count - 1) // LabelEvery + 1
+    Lines.append(f"{Prefix}_0:")
+    for i in range(Count):
+        if i and i % LabelEvery == 0:
+            Lines.append(f"{Prefix}_{i // LabelEvery}:")
+        Current = i // LabelEvery
+        if Current + 1 < Labels and Rng.random() < Forward:
+            Target = Rng.randrange(Current + 1, Labels) # Not defined yet, becomes a fixup
+        else:
+            Target = Rng.randrange(0, Current + 1)
+        Lines.append("    " + Statement(Rng, f"{Prefix}_{Target}"))
+        if Children and i == Count // 2:
+            Lines.extend(f'%include "{Child}"' for Child in Children)
+    Lines.append(f"{Prefix}_TABLE:")
+    for i in range(0, TableSize, 16):
+        Lines.append("    D8 " + ", ".join(str(Rng.randrange(256)) for j in range(min(16, TableSize - i))))
+    Lines.append(f"    TIMES {TableSize // 8} D64 {Prefix}_TABLE, {Prefix}_END - {Prefix}_TABLE")
+    Lines.append(f"    RES8 {TableSize}")
+    Lines.append('%incbin "blob.bin"')
+    Lines.append(f"{Prefix}_END:")
+    if Root:
+        Lines.append("BENCH_START:")
+        Lines.append("    RET")
+    return "\n".join(Lines) + "\n"
+
+def Generate(Directory, Statements, Depth, Fanout, Forward, TableSize, Seed):
+    # Writes the program into Directory and returns the path of the main file
+    Rng = random.Random(Seed)
+    Nodes = [("main.asm", 0)]
+    Tree = {}
+    for Name, Level in Nodes:
+        Tree[Name] = []
+        if Level < Depth:
+            for i in range(Fanout):
+                Child = f"{os.path.splitext(Name)[0]}_{i}.asm"
+                Tree[Name].append(Child)
+                Nodes.append((Child, Level + 1))
+    Count = max(Statements // len(Nodes), 1)
+    for Index, (Name, Level) in enumerate(Nodes):
+        with open(os.path.join(Directory, Name), "w") as File:
+            File.write(Node(Rng, f"N{Index}", Count, Tree[Name], Forward, TableSize, Index == 0))
+    with open(os.path.join(Directory, "common.asm"), "w") as File:
+        File.write("%pragma once\n"
+                   "BENCH_BASE EQU 0x20000\n"
+                   "%define BENCH_STRIDE 8\n"
+                   "BENCH_COMMON:\n"
+                   "    MOV64 G0, [BENCH_BASE + 8]\n"
+                   "    RET\n")
+    with open(os.path.join(Directory, "repeat.asm"), "w") as File:
+        for i in range(32):
+            File.write(f"    {Statement(Rng, 'BENCH_COMMON')}\n")
+    with open(os.path.join(Directory, "blob.bin"), "wb") as File:
+        File.write(Rng.randbytes(TableSize))
+    return os.path.join(Directory, "main.asm")
+
+def Run(Main, Output):
+    gc.collect()
+    Stats = aasm.Stats()
+    aasm.AssembleFile(Main, Output, Stats=Stats)
+    gc.collect()
+    Start = time.perf_counter()
+    aasm.AssembleFile(Main, Output) # The streaming path a normal build takes
+    return Stats, time.perf_counter() - Start
+
+def PeakTraced(Main, Output):
+    # A separate run as tracing slows everything down, Stats charges the
+    # traced peak between two of its marks to the phase ending there
+    gc.collect()
+    Stats = aasm.Stats()
+    tracemalloc.start()
+    aasm.AssembleFile(Main, Output, Stats=Stats)
+    tracemalloc.stop()
+    return {Phase: Peak // 1024 for Phase, Peak in Stats.Peaks.items()}
+
+def Measure(Main, Output, Runs):
+    # The fastest run is kept, slower ones only add scheduler and cache noise
+    Phases = {}
+    Walls = []
+    for i in range(Runs):
+        Stats, Wall = Run(Main, Output)
+        for Phase in Stats.Phases:
+            Phases.setdefault(Phase, []).append(Stats.Phases[Phase])
+        Walls.append(Wall)
+    Files = Stats.Files.values()
+    return {"Tokens": sum(Counts[0] for Counts in Files),
+            "Statements": sum(Counts[1] for Counts in Files),
+            "Files": len(Stats.Files),
+            "Labels": Stats.Labels,
+            "Fixups": Stats.Fixups,
+            "Size": Stats.Size,
+            "Phases": {Phase: min(Phases[Phase]) for Phase in Phases},
+            "Wall": min(Walls),
+            "PeakKiB": PeakTraced(Main, Output)}
+
+def Report(Results, Baseline, Threshold):
+    Slower = 0
+    for Case, Result in Results["Cases"].items():
+        print(f"{Case} statements: {Result['Statements']} statements, {Result['Tokens']} tokens, "
+              f"{Result['Files']} files, {Result['Labels']} labels, {Result['Fixups']} fixups, {Result['Size']} bytes")
+        Base = Baseline["Cases"].get(Case) if Baseline else None
+        Rows = [(Phase, Result["Phases"][Phase], Base and Base["Phases"].get(Phase)) for Phase in Result["Phases"]]
+        Rows.append(("Wall", Result["Wall"], Base and Base.get("Wall")))
+        for Name, Value, Old in Rows:
+            Line = f"  {Name:<12}{Value * 1000:10.2f} ms"
+            if Old:
+                Ratio = Value / Old
+                Line += f"{Old * 1000:10.2f} ms  x{Ratio:.2f}"
+                if Ratio > 1 + Threshold and max(Value, Old) >= NoiseFloor:
+                    Line += "  SLOWER"
+                    Slower += 1
+            print(Line)
+        print("  Peak memory:")
+        for Phase, Peak in Result["PeakKiB"].items():
+            Line = f"  {Phase:<12}{Peak:10} KiB"
+            Old = Base and isinstance(Base.get("PeakKiB"), dict) and Base["PeakKiB"].get(Phase)
+            if Old:
+                Line += f"{Old:10} KiB  x{Peak / Old:.2f}"
+            print(Line)
+    return Slower
+
+if __name__ == "__main__":
+    ArgParser = argparse.ArgumentParser(prog="bench", description="Benchmarks aasm on generated programs.")
+    ArgParser.add_argument("--scales", default="2000,20000,100000", help="comma separated statement counts, one case each")
+    ArgParser.add_argument("--runs", type=int, default=5, help="runs per case, the fastest is reported")
+    ArgParser.add_argument("--depth", type=int, default=3, help="depth of the include tree")
+    ArgParser.add_argument("--fanout", type=int, default=3, help="includes per file of the include tree")
+    ArgParser.add_argument("--forward", type=float, default=0.5, help="share of label uses that are forward references")
+    ArgParser.add_argument("--table", type=int, default=512, help="bytes of D8, RES and INCBIN tables per file")
+    ArgParser.add_argument("--seed", type=int, default=1)
+    ArgParser.add_argument("--baseline", metavar="FILE", help="compare with results saved by --save")
+    ArgParser.add_argument("--save", metavar="FILE", help="save the results as JSON")
+    ArgParser.add_argument("--threshold", type=float, default=0.25, help="slowdown over the baseline that counts as a regression")
+    ArgParser.add_argument("--fail", action="store_true", help="exit with an error when a timing regressed")
+    ArgParser.add_argument("--keep", metavar="DIR", help="generate the programs into DIR and keep them")
+    Args = ArgParser.parse_args()
+
+    Params = {"Depth": Args.depth, "Fanout": Args.fanout, "Forward": Args.forward,
+              "Table": Args.table, "Seed": Args.seed, "Runs": Args.runs}
+    Baseline = None
+    if Args.baseline:
+        with open(Args.baseline, "r") as File:
+            Baseline = json.load(File)
+        if Baseline.get("Params") != Params:
+            print(f"Warning: {Args.baseline} was made with different parameters {Baseline.get('Params')}")
+        if (Baseline.get("Python"), Baseline.get("Machine")) != (platform.python_version(), platform.machine()):
+            print(f"Warning: {Args.baseline} was made with Python {Baseline.get('Python')} on {Baseline.get('Machine')}")
+
+    Root = Args.keep or tempfile.mkdtemp(prefix="aasm-bench-")
+    Results = {"Python": platform.python_version(), "Machine": platform.machine(), "Params": Params, "Cases": {}}
+    try:
+        for Scale in Args.scales.split(","):
+            Directory = os.path.join(Root, Scale)
+            os.makedirs(Directory, exist_ok=True)
+            Main = Generate(Directory, int(Scale), Args.depth, Args.fanout, Args.forward, Args.table, Args.seed)
+            Results["Cases"][Scale] = Measure(Main, os.path.join(Directory, "main.bin"), Args.runs)
+    except aasm.AssemblerError as Err:
+        print(aasm.FormatError(Err))
+        exit(1)
+    finally:
+        if not Args.keep:
+            shutil.rmtree(Root)
+
+    Slower = Report(Results, Baseline, Args.threshold)
+    if Args.save:
+        with open(Args.save, "w") as File:
+            json.dump(Results, File, indent=2)
+    if Slower:
+        print(f"{Slower} timings are more than {Args.threshold:.0%} slower than the baseline.")
+        if Args.fail:
+            exit(1)
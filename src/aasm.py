@@ -1,8 +1,44 @@
 import sys
 import os
+import re
+import struct
+import argparse
+import hashlib
+import marshal
+import mmap
+import json
+import time
+import io
+import gc
+import tracemalloc
+import threading
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from itertools import chain, repeat
+from bisect import bisect_left, bisect_right
 from enum import Enum
+import aobj
+try:
+    import resource
+except ImportError: # Not available on Windows, peak memory is left out there
+    resource = None
 
-TokenType = Enum("TokenType", "Eof Add Sub Mul Div Rem Mov Jmp Rel Push Pop Call Ret And Or Xor Not Shl Shr Sei Sdi Int Cmp Org Id Str Define Res Reg Num Comma LBrac RBrac Colon Plus Minus PreProc")
+def SourceHash(*Paths):
+    # Hash of the assembler's own sources, caches made by any other version
+    # are never reused. Without the sources nothing is reused at all.
+    Hash = hashlib.sha256()
+    try:
+        for Path in Paths:
+            with open(Path, "rb") as File:
+                Hash.update(File.read())
+    except OSError:
+        return os.urandom(32).hex()
+    return Hash.hexdigest()
+
+Version = SourceHash(__file__, aobj.__file__)
+
+TokenType = Enum("TokenType", "Eof Add Sub Mul Div Rem Mov Jmp Rel Push Pop Call Ret And Or Xor Not Shl Shr Sei Sdi Int Cmp Org Id Str Define Res Reg Num Comma LBrac RBrac Colon Plus Minus PreProc Times Star Slash LShift RShift Amp Pipe LParen RParen Equ")
 
 class OpCodes(Enum):
     Nop =  0b000000
@@ -28,12 +64,33 @@ class OpCodes(Enum):
     Cmp =  0b010100
     Rem =  0b010101
 
-def NewToken(Type, Value, Position):
-    return (Type, Value, Position)
+# Little-endian encoders for each operand width in bytes
+Packers = {1: struct.Struct("<B"), 2: struct.Struct("<H"),
+           4: struct.Struct("<I"), 8: struct.Struct("<Q")}
+PackCodes = {1: "B", 2: "H", 4: "I", 8: "Q"}
+Masks = {1: 0xFF, 2: 0xFFFF, 4: 0xFFFFFFFF, 8: 0xFFFFFFFFFFFFFFFF}
+
+# Binary operators of assemble-time expressions, (precedence, operator),
+# a higher precedence binds tighter
+BinaryOps = {TokenType.Pipe: (1, "|"), TokenType.Amp: (2, "&"),
+             TokenType.LShift: (3, "<<"), TokenType.RShift: (3, ">>"),
+             TokenType.Plus: (4, "+"), TokenType.Minus: (4, "-"),
+             TokenType.Star: (5, "*"), TokenType.Slash: (5, "/")}
+Operators = {"|": lambda A, B: A | B,
+             "&": lambda A, B: A & B,
+             "<<": lambda A, B: A << B,
+             ">>": lambda A, B: A >> B,
+             "+": lambda A, B: A + B,
+             "-": lambda A, B: A - B,
+             "*": lambda A, B: A * B,
+             "/": lambda A, B: -(-A // B) if (A < 0) != (B < 0) else A // B} # Rounds towards zero
 
 Keywords = {}
 SingleChars = {',': TokenType.Comma, '[': TokenType.LBrac, ']': TokenType.RBrac,
-               '+': TokenType.Plus, '-': TokenType.Minus, ':': TokenType.Colon}
+               '+': TokenType.Plus, '-': TokenType.Minus, ':': TokenType.Colon,
+               '*': TokenType.Star, '/': TokenType.Slash, '<<': TokenType.LShift,
+               '>>': TokenType.RShift, '&': TokenType.Amp, '|': TokenType.Pipe,
+               '(': TokenType.LParen, ')': TokenType.RParen}
 PrefixKw = {"add": TokenType.Add, "sub": TokenType.Sub,
             "mul": TokenType.Mul, "div": TokenType.Div,
             "mov": TokenType.Mov, "push": TokenType.Push,
@@ -43,8 +100,34 @@ PrefixKw = {"add": TokenType.Add, "sub": TokenType.Sub,
             "shl": TokenType.Shl, "shr": TokenType.Shr,
             "res": TokenType.Res, "cmp": TokenType.Cmp,
             "rem": TokenType.Rem}
-Macros = {}
+Mnemonics = {}
+
+class AssemblerError(Exception):
+    # str() gives the full message as printed on the command line, the parts
+    # are kept for callers of Assemble that want to report it themselves
+    def __init__(self, Text, Message=None, File=None, Row=None, Column=None):
+        super().__init__(Text)
+        self.Message = Text if Message is None else Message
+        self.File = File
+        self.Row = Row
+        self.Column = Column
+
+def Instruction(Size, OpCode, Src, Dst, Flags):
+    Instruction = Size << 14
+    Instruction |= OpCode.value << 8
+    Instruction |= Src << 6
+    Instruction |= Dst << 4
+    Instruction |= Flags
+    return Instruction
+
+def NewMnemonic(Type, Handler, OpCode, Size, CondFlags=0):
+    # The header holds size and opcode, handlers OR in the operand modes and flags
+    Header = Instruction(Size, OpCode, 0, 0, 0) if OpCode else 0
+    return (Type, Handler, OpCode, Size, Header, CondFlags)
+
 def CreateKeywords():
+    if Mnemonics:
+        return
     NoPrefixKw = {"org": TokenType.Org,
                   "jmp": TokenType.Jmp,
                   "jc": TokenType.Jmp,
@@ -60,7 +143,9 @@ def CreateKeywords():
                   "ret": TokenType.Ret,
                   "sei": TokenType.Sei,
                   "sdi": TokenType.Sdi,
-                  "int": TokenType.Int}
+                  "int": TokenType.Int,
+                  "times": TokenType.Times,
+                  "equ": TokenType.Equ}
     for Keyword in PrefixKw:
         for i in ["8", "16", "32", "64"]:
             Keywords[f"{Keyword}{i}"] = PrefixKw[Keyword]
@@ -78,130 +163,648 @@ def CreateKeywords():
     Keywords["ivtbl"] = TokenType.Reg
     Keywords["err"] = TokenType.Reg
 
-def Tokenize(Input):
-    Input += "\n"
-    Tokens = []
-    Index = 0
-    Position = [1, 1] # Row, Column
-    while Index < len(Input):
-        if Input[Index] in " \t\n\r":
-            if Input[Index] in "\n\r":
-                Position[0] += 1
-                Position[1] = 1
+    # Statements, keyed by the lowercased mnemonic the tokenizer produces
+    PrefixHandlers = {"add": (Parser.HandleOpInst, OpCodes.Add),
+                      "sub": (Parser.HandleOpInst, OpCodes.Sub),
+                      "mul": (Parser.HandleOpInst, OpCodes.Mul),
+                      "div": (Parser.HandleOpInst, OpCodes.Div),
+                      "rem": (Parser.HandleOpInst, OpCodes.Rem),
+                      "mov": (Parser.HandleOpInst, OpCodes.Mov),
+                      "and": (Parser.HandleOpInst, OpCodes.And),
+                      "or": (Parser.HandleOpInst, OpCodes.Or),
+                      "xor": (Parser.HandleOpInst, OpCodes.Xor),
+                      "shl": (Parser.HandleOpInst, OpCodes.Shl),
+                      "shr": (Parser.HandleOpInst, OpCodes.Shr),
+                      "cmp": (Parser.HandleOpInst, OpCodes.Cmp),
+                      "push": (Parser.HandlePush, OpCodes.Push),
+                      "pop": (Parser.HandlePop, OpCodes.Pop),
+                      "not": (Parser.HandleNot, OpCodes.Not),
+                      "d": (Parser.HandleDefine, None),
+                      "res": (Parser.HandleRes, None)}
+    for Keyword in PrefixHandlers:
+        Handler, OpCode = PrefixHandlers[Keyword]
+        for Size, i in enumerate(["8", "16", "32", "64"]):
+            Mnemonics[f"{Keyword}{i}"] = NewMnemonic(PrefixKw[Keyword], Handler, OpCode, Size)
+    JmpConds = {"jmp": 0b00000000,
+                "jc":  0b00000010,
+                "jz":  0b00000100,
+                "je":  0b00000100,
+                "jne": 0b00011000,
+                "jg":  0b00001000,
+                "jge": 0b00001100,
+                "jl":  0b00010000,
+                "jle": 0b00010100}
+    for Keyword in JmpConds:
+        Mnemonics[Keyword] = NewMnemonic(TokenType.Jmp, Parser.HandleJmp, OpCodes.Jmp, 3, JmpConds[Keyword])
+    Mnemonics["org"] = NewMnemonic(TokenType.Org, Parser.HandleOrg, None, 0)
+    Mnemonics["call"] = NewMnemonic(TokenType.Call, Parser.HandleCall, OpCodes.Call, 3)
+    Mnemonics["ret"] = NewMnemonic(TokenType.Ret, Parser.HandleSimpleInst, OpCodes.Ret, 3)
+    Mnemonics["sei"] = NewMnemonic(TokenType.Sei, Parser.HandleSimpleInst, OpCodes.Sei, 3)
+    Mnemonics["sdi"] = NewMnemonic(TokenType.Sdi, Parser.HandleSimpleInst, OpCodes.Sdi, 3)
+    Mnemonics["int"] = NewMnemonic(TokenType.Int, Parser.HandleInt, OpCodes.Int, 0)
+    Mnemonics["times"] = NewMnemonic(TokenType.Times, Parser.HandleTimes, None, 0)
+
+TokenPattern = re.compile(r"""[ \t]*(?:
+    (?P<Id>[A-Za-z_.][A-Za-z0-9_.]*)
+  | (?P<Single><<|>>|[,\[\]+\-:*/&|()])
+  | (?P<Num>[0-9][xXbB]?[0-9A-Fa-f]*)
+  | (?P<Comment>;.*)
+  | (?P<Str>"[^"\r]*")
+  | (?P<PreProc>%[A-Za-z0-9_.]*)
+  | (?P<Return>\r)
+  | (?P<BadStr>")
+  | (?P<Bad>[^ \t])
+)""", re.VERBOSE)
+LineCacheSize = 4096
+IncludePattern = re.compile(r'^[ \t]*%include[ \t]+"([^"\r\n]*)"', re.MULTILINE | re.IGNORECASE)
+
+def ScanLine(Line, Row):
+    # Lines never contain '\n', '\r' still starts a new row like the old scanner did
+    Types = []
+    Values = []
+    Rows = []
+    Columns = []
+    LineStart = 0
+    GetKeyword = Keywords.get
+    for Match in TokenPattern.finditer(Line):
+        Kind = Match.lastgroup
+        Start = Match.start(Kind)
+        Text = Match.group(Kind)
+        if Kind == "Id":
+            Lower = Text.lower()
+            Type = GetKeyword(Lower)
+            if Type is None:
+                Type = TokenType.Id
             else:
-                Position[1] += 1
-            Index += 1
-        elif ('a' <= Input[Index] <= 'z'
-              or 'A' <= Input[Index] <= 'Z'
-              or Input[Index] == '_' or Input[Index] == '.'):
-            Id = ""
-            while ('a' <= Input[Index] <= 'z'
-                   or 'A' <= Input[Index] <= 'Z'
-                   or '0' <= Input[Index] <= '9'
-                   or Input[Index] == '_' or Input[Index] == '.'):
-                Id += Input[Index]
-                Index += 1
-            Type = TokenType.Id
-            if Id.lower() in Keywords:
-                Id = Id.lower()
-                Type = Keywords[Id]
-            Tokens.append(NewToken(Type, Id, (Position[0], Position[1])))
-            Position[1] += len(Id)
-        elif '0' <= Input[Index] <= '9':
-            Hex = False
-            Bin = False
-            Num = ""
-            if Input[Index + 1].lower() == 'x':
-                Hex = True
-                Index += 2
-                Num += "0x"
-            elif Input[Index + 1].lower() == 'b':
-                Bin = True
-                Index += 2
-                Num += "0b"
-            while ('a' <= Input[Index] <= 'f'
-                   or 'A' <= Input[Index] <= 'F'
-                   or '0' <= Input[Index] <= '9'):
-                if Bin:
-                    if Input[Index] > '1':
-                        Position[1] += len(Num)
-                        print(f"Unexpected non-binary (0 or 1) character while consuming binary number at {Position[0]}:{Position[1]}")
-                        exit(1)
-                Num += Input[Index]
-                Index += 1
-            Tokens.append(NewToken(TokenType.Num, Num, (Position[0], Position[1])))
-            Position[1] += len(Num)
-        elif Input[Index] == '"':
-            Str = ""
-            Index += 1
-            Position[1] += 1
-            while Input[Index] != '"':
-                if Input[Index] in '\n\r':
-                    print(f"Unexpected new line at string {Position[0]}:{Position[1]}")
-                    exit(1)
-                Str += Input[Index]
-                Position[1] += 1
-                Index += 1
-            Index += 1
-            Position[1] += 1
-            Tokens.append(NewToken(TokenType.Str, Str, (Position[0], Position[1])))
-        elif Input[Index] == ';':
-            while Input[Index] != '\n':
-                Index += 1
-        elif Input[Index] == '%':
-            Index += 1
-            Position[1] += 1
-            Id = ""
-            while ('a' <= Input[Index] <= 'z'
-                   or 'A' <= Input[Index] <= 'Z'
-                   or '0' <= Input[Index] <= '9'
-                   or Input[Index] == '_' or Input[Index] == '.'):
-                Id += Input[Index]
-                Index += 1
-            Tokens.append(NewToken(TokenType.PreProc, Id.lower(), (Position[0], Position[1] - 1)))
-            Position[1] += len(Id)
-        elif Input[Index] in SingleChars:
-            Tokens.append(NewToken(SingleChars[Input[Index]], Input[Index], (Position[0], Position[1])))
-            Index += 1
-            Position[1] += 1
+                Text = Lower
+        elif Kind == "Single":
+            Type = SingleChars[Text]
+        elif Kind == "Num":
+            Type = TokenType.Num
+            if len(Text) > 1 and Text[1] in "xX":
+                Text = "0x" + Text[2:]
+            elif len(Text) > 1 and Text[1] in "bB":
+                Text = "0b" + Text[2:]
+                for i in range(2, len(Text)):
+                    if Text[i] > '1':
+                        Message = "Unexpected non-binary (0 or 1) character while consuming binary number"
+                        Column = Start + i - LineStart + 1
+                        raise AssemblerError(f"{Message} at {Row}:{Column}", Message, None, Row, Column)
+        elif Kind == "Comment":
+            break
+        elif Kind == "Str":
+            Type = TokenType.Str
+            Text = Text[1:-1]
+            Start = Match.end() # Strings are positioned after the closing quote
+        elif Kind == "PreProc":
+            Type = TokenType.PreProc
+            Text = Text[1:].lower()
+        elif Kind == "Return":
+            Row += 1
+            LineStart = Match.end()
+            continue
+        elif Kind == "BadStr":
+            End = Line.find("\r", Start)
+            if End < 0:
+                End = len(Line)
+            Column = End - LineStart + 1
+            raise AssemblerError(f"Unexpected new line at string {Row}:{Column}", "Unexpected new line at string", None, Row, Column)
         else:
-            print(f"Unexpected character {Input[Index]} at {Position[0]}:{Position[1]}")
-            exit(1)
-    Tokens.append(NewToken(TokenType.Eof, "", (Position[0], Position[1])))
-    return Tokens
+            Column = Start - LineStart + 1
+            raise AssemblerError(f"Unexpected character {Text} at {Row}:{Column}", f"Unexpected character {Text}", None, Row, Column)
+        Types.append(Type)
+        Values.append(Text)
+        Rows.append(Row)
+        Columns.append(Start - LineStart + 1)
+    return Types, Values, Rows, Columns, Row
+
+def ScanLines(Input):
+    # Generated sources repeat lines a lot, so scanned lines are cached and
+    # reused for later rows instead of being rescanned. The cache only helps
+    # repeated lines, on lines that don't repeat the scanner itself is about
+    # 1.7x faster than the old per-character loop. That is near the floor
+    # for tokens in this format: on 250k unique tokens the old loop takes
+    # ~630 ms, one findall pass over the text ~50 ms and building the token
+    # tuples alone another ~50 ms, so 10x is out of reach in Python.
+    # Yields (Row, Types, Values, Rows, Columns) per line, Rows is None when
+    # every token of the line sits on Row.
+    Cache = {}
+    Row = 1
+    for Line in Input.split("\n"):
+        Cached = Cache.get(Line)
+        if Cached is None:
+            Types, Values, Rows, Columns, EndRow = ScanLine(Line, Row)
+            if EndRow == Row:
+                if len(Cache) < LineCacheSize:
+                    Cache[Line] = (Types, Values, Columns)
+                Rows = None
+            yield Row, Types, Values, Rows, Columns
+            Row = EndRow + 1
+        else:
+            yield Row, Cached[0], Cached[1], None, Cached[2]
+            Row += 1
+    yield Row, [TokenType.Eof], [""], None, [1]
+
+def TokenizeStream(Input):
+    for Row, Types, Values, Rows, Columns in ScanLines(Input):
+        if Types:
+            yield from zip(Types, Values, zip(repeat(Row) if Rows is None else Rows, Columns))
+
+def Tokenize(Input):
+    # Tokens can't form cycles, the collector is paused so it doesn't walk
+    # the growing list again and again
+    Enabled = gc.isenabled()
+    gc.disable()
+    try:
+        AllTypes = []
+        AllValues = []
+        AllRows = []
+        AllColumns = []
+        for Row, Types, Values, Rows, Columns in ScanLines(Input):
+            if Types:
+                AllTypes += Types
+                AllValues += Values
+                AllRows += [Row] * len(Types) if Rows is None else Rows
+                AllColumns += Columns
+        return list(zip(AllTypes, AllValues, zip(AllRows, AllColumns)))
+    finally:
+        if Enabled:
+            gc.enable()
+
+class TokenStore:
+    # The tokens of one file as parallel columns: type codes, indexes into a
+    # table of the distinct token values, rows and columns. A token costs 13
+    # bytes here instead of three tuples, the tuples the parser reads are
+    # built one at a time while it iterates.
+    def __init__(self, Types=b"", Strings=(), Values=b"", Rows=b"", Columns=b""):
+        self.Types = array("B", Types)
+        self.Strings = list(Strings)
+        self.Values = array("I")
+        self.Values.frombytes(Values)
+        self.Rows = array("I")
+        self.Rows.frombytes(Rows)
+        self.Columns = array("I")
+        self.Columns.frombytes(Columns)
+
+    def __len__(self):
+        return len(self.Types)
+
+    def __iter__(self):
+        TokenTypes = list(TokenType)
+        return zip(map(TokenTypes.__getitem__, self.Types),
+                   map(self.Strings.__getitem__, self.Values),
+                   zip(self.Rows, self.Columns))
+
+    def Columnar(self):
+        # (Types, Strings, Values, Rows, Columns) as bytes and a list, for marshal
+        return (self.Types.tobytes(), self.Strings, self.Values.tobytes(), self.Rows.tobytes(), self.Columns.tobytes())
+
+class Interner(dict):
+    # Value -> index, a new value gets the next index
+    def __missing__(self, Value):
+        Index = self[Value] = len(self)
+        return Index
+
+TypeCodes = {id(Type): Type.value - 1 for Type in TokenType} # By id, hashing an Enum member runs Python code
+
+def TokenizeStore(Input):
+    Store = TokenStore()
+    Indexes = Interner()
+    for Row, Types, Values, Rows, Columns in ScanLines(Input):
+        if Types:
+            Store.Types.frombytes(bytes(map(TypeCodes.__getitem__, map(id, Types))))
+            Store.Values.fromlist(list(map(Indexes.__getitem__, Values)))
+            Store.Rows.fromlist([Row] * len(Types) if Rows is None else Rows)
+            Store.Columns.fromlist(Columns)
+    Store.Strings = list(Indexes)
+    return Store
+
+class TokenCache:
+    # Cache of token streams keyed by the hash of the file contents. On disk
+    # entries are the marshalled columns of a TokenStore. A resident cache
+    # also keeps the tokens of every file used since the last Trim in memory.
+    def __init__(self, Directory=None, Resident=False):
+        self.Directory = Directory
+        self.Resident = Resident
+        self.Memory = {}
+        self.Used = set()
+        if Directory:
+            os.makedirs(Directory, exist_ok=True)
+        Lexer = hashlib.sha256(f"{Version}\0{marshal.version}\0{TokenPattern.pattern}".encode())
+        for Keyword in sorted(Keywords):
+            Lexer.update(f"\0{Keyword}={Keywords[Keyword].value}".encode())
+        self.Salt = Lexer.digest()
+
+    def Key(self, Text):
+        return hashlib.sha256(self.Salt + Text.encode()).hexdigest()
+
+    def Load(self, Path):
+        try:
+            with open(Path, "rb") as File:
+                return TokenStore(*marshal.load(File))
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def Store(self, Path, Tokens):
+        Temp = f"{Path}.{os.getpid()}"
+        with open(Temp, "wb") as File:
+            marshal.dump(Tokens.Columnar(), File)
+        os.replace(Temp, Path)
+
+    def Tokenize(self, Text):
+        Key = self.Key(Text)
+        Tokens = self.Memory.get(Key)
+        if Tokens is not None:
+            self.Used.add(Key)
+            return Tokens
+        Path = os.path.join(self.Directory, Key + ".tok") if self.Directory else None
+        if Path:
+            Tokens = self.Load(Path)
+        if Tokens is None:
+            Tokens = TokenizeStore(Text)
+            if Path:
+                try:
+                    self.Store(Path, Tokens)
+                except OSError:
+                    pass # The cache is only an optimisation
+        if self.Resident:
+            self.Memory[Key] = Tokens
+            self.Used.add(Key)
+        return Tokens
+
+    def Trim(self):
+        # Forget files that were not used since the last call
+        for Key in self.Memory.keys() - self.Used:
+            del self.Memory[Key]
+        self.Used = set()
+
+def FindFile(Name, Directories):
+    for Directory in Directories:
+        Path = os.path.join(Directory, Name)
+        if os.path.isfile(Path):
+            return os.path.realpath(Path)
+    return None
+
+def PrefetchJob(Path, CacheDir):
+    # Runs in a worker process: the tokens of Path and the names it includes.
+    # The tokens are None when reading or tokenizing fails, the parser then
+    # reads the file itself and reports the error as it always did.
+    try:
+        with open(Path, "r") as File:
+            Text = File.read()
+    except (OSError, UnicodeDecodeError):
+        return None, []
+    Names = IncludePattern.findall(Text)
+    try:
+        return (TokenCache(CacheDir).Tokenize(Text) if CacheDir else TokenizeStore(Text)), Names
+    except AssemblerError:
+        return None, Names
+
+class Prefetcher:
+    # Reads and tokenizes included files in worker processes ahead of the
+    # parser. Sources are scanned for %include lines, each name is resolved
+    # like Parser.FindInclude does and every file is submitted once, its own
+    # includes when its job is done. The parser takes the tokens when it
+    # reaches the include, so the output never depends on which job finishes
+    # first. A name the scan gets wrong only costs a job nobody takes.
+    def __init__(self, IncludePaths=(), Workers=None, CacheDir=None):
+        self.IncludePaths = list(IncludePaths)
+        self.CacheDir = CacheDir
+        self.Pool = ProcessPoolExecutor(Workers)
+        self.Jobs = {}
+        self.Lock = threading.Lock()
+        self.Closed = False
+
+    def Scan(self, Text, Path):
+        self.Submit(IncludePattern.findall(Text), Path)
+
+    def Submit(self, Names, Includer):
+        for Name in Names:
+            Path = FindFile(Name, [os.path.dirname(Includer)] + self.IncludePaths)
+            if Path is None:
+                continue
+            with self.Lock:
+                if self.Closed or Path in self.Jobs:
+                    continue
+                Job = self.Jobs[Path] = self.Pool.submit(PrefetchJob, Path, self.CacheDir)
+            Job.add_done_callback(lambda Job, Path=Path: self.Done(Job, Path))
+
+    def Done(self, Job, Path):
+        if not Job.cancelled() and Job.exception() is None:
+            self.Submit(Job.result()[1], Path)
+
+    def Take(self, Path):
+        # The tokens of Path, None when the parser has to read it itself
+        with self.Lock:
+            Job = self.Jobs.get(Path)
+        if Job is None:
+            return None
+        try:
+            return Job.result()[0]
+        except Exception:
+            return None # A broken pool only loses the head start
+
+    def Close(self):
+        with self.Lock:
+            self.Closed = True
+        self.Pool.shutdown(cancel_futures=True) # Only waits for jobs already running
+
+SrcModes = ("reg", "[reg]", "imm", "[abs]")
+DstModes = ("reg", "[reg]", "[abs]", "?")
+
+def OperandMode(Names, Mode, Flags, OffFlag, RegOffFlag):
+    if not Flags & OffFlag:
+        return Names[Mode]
+    return Names[Mode][:-1] + ("+reg]" if Flags & RegOffFlag else "+imm]")
+
+class Stats:
+    # Instrumentation for --stats, filled in by the parser when it is given
+    # one. Times are in seconds, tokenizing happens up front per file so it
+    # can be timed apart from parsing.
+    def __init__(self):
+        self.Phases = dict.fromkeys(["Read", "Tokenize", "Include", "Parse", "Postamble", "Write"], 0.0)
+        self.Files = {} # Path: [Tokens, Statements]
+        self.Opcodes = {} # Mnemonic: [Count, Bytes]
+        self.Modes = {} # Addressing mode: [Count, Bytes]
+        self.Labels = 0
+        self.Constants = 0
+        self.Fixups = 0
+        self.Relocations = 0
+        self.Size = 0
+        self.PeakMemory = None # KiB
+        self.Peaks = dict.fromkeys(self.Phases, 0) # Bytes, only when tracemalloc is tracing
+
+    def Time(self, Phase, Start):
+        Now = time.perf_counter()
+        self.Phases[Phase] += Now - Start
+        self.Mark(Phase)
+        return Now
+
+    def Mark(self, Phase):
+        # The traced peak since the last mark is charged to Phase
+        if tracemalloc.is_tracing():
+            self.Peaks[Phase] = max(self.Peaks[Phase], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+    def Tokens(self, Path, Tokens):
+        self.Files.setdefault(Path, [0, 0])[0] += len(Tokens) - 1 # Without the Eof
+
+    def Statement(self, LocalParser, Token, Mnemonic, File, Before):
+        self.Files.setdefault(File, [0, 0])[1] += 1
+        Emitted = LocalParser.Size() - Before
+        if Mnemonic is not None and Mnemonic[0] == Token[0]:
+            Key = Token[1].upper() if Mnemonic[2] is None else Mnemonic[2].name.upper()
+        elif Token[0] == TokenType.PreProc:
+            Key = f"%{Token[1].upper()}"
+        else:
+            return
+        Entry = self.Opcodes.setdefault(Key, [0, 0])
+        Entry[0] += 1
+        Entry[1] += Emitted
+        if Mnemonic is None or Mnemonic[2] is None or Emitted < 2:
+            return
+        Start = len(LocalParser.Program) - Emitted
+        Header = LocalParser.Program[Start] | LocalParser.Program[Start + 1] << 8
+        Src = OperandMode(SrcModes, (Header >> 6) & 3, Header, 0b0001, 0b0100)
+        Dst = OperandMode(DstModes, (Header >> 4) & 3, Header, 0b0010, 0b1000)
+        Handler = Mnemonic[1]
+        if Handler == Parser.HandleOpInst:
+            Mode = f"{Dst}, {Src}"
+        elif Handler == Parser.HandlePop or Handler == Parser.HandleNot:
+            Mode = Dst
+        elif Handler == Parser.HandleSimpleInst:
+            Mode = "-"
+        else:
+            Mode = Src
+        Entry = self.Modes.setdefault(Mode, [0, 0])
+        Entry[0] += 1
+        Entry[1] += Emitted
+
+    def Finish(self, LocalParser):
+        self.Labels = len(LocalParser.Labels)
+        self.Constants = len(LocalParser.Constants)
+        self.Relocations = len(LocalParser.Fixups) if LocalParser.Relocatable else 0
+        self.Size = LocalParser.Size()
+        if resource is not None:
+            self.PeakMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform == "darwin":
+                self.PeakMemory //= 1024 # Bytes there, KiB elsewhere
+
+    def Json(self):
+        Table = lambda Entries: {Key: {"Count": Entries[Key][0], "Bytes": Entries[Key][1]} for Key in sorted(Entries)}
+        return {"Phases": self.Phases,
+                "Total": sum(self.Phases.values()),
+                "PeakMemoryKiB": self.PeakMemory,
+                "PhasePeaksKiB": {Phase: Peak // 1024 for Phase, Peak in self.Peaks.items()} if any(self.Peaks.values()) else None,
+                "Files": {os.path.relpath(Path): {"Tokens": Counts[0], "Statements": Counts[1]} for Path, Counts in self.Files.items()},
+                "Labels": self.Labels,
+                "Constants": self.Constants,
+                "Fixups": self.Fixups,
+                "Relocations": self.Relocations,
+                "Size": self.Size,
+                "Opcodes": Table(self.Opcodes),
+                "Modes": Table(self.Modes)}
+
+    def Text(self):
+        Lines = ["Phases:"]
+        for Phase in self.Phases:
+            Line = f"  {Phase:<12}{self.Phases[Phase] * 1000:10.2f} ms"
+            if any(self.Peaks.values()):
+                Line += f"{self.Peaks[Phase] // 1024:10} KiB peak"
+            Lines.append(Line)
+        Lines.append(f"  {'Total':<12}{sum(self.Phases.values()) * 1000:10.2f} ms")
+        if self.PeakMemory is not None:
+            Lines.append(f"Peak memory: {self.PeakMemory} KiB")
+        Lines.append("Files:")
+        for Path, (Tokens, Statements) in self.Files.items():
+            Lines.append(f"  {os.path.relpath(Path):<32}{Tokens:8} tokens{Statements:8} statements")
+        Lines.append(f"Labels: {self.Labels}  Constants: {self.Constants}  Fixups: {self.Fixups}  Relocations: {self.Relocations}")
+        Lines.append(f"Size: {self.Size} bytes")
+        for Title, Entries in (("Opcodes:", self.Opcodes), ("Addressing modes:", self.Modes)):
+            Lines.append(Title)
+            for Key in sorted(Entries, key=lambda Key: -Entries[Key][1]):
+                Lines.append(f"  {Key:<24}{Entries[Key][0]:8} x{Entries[Key][1]:10} bytes")
+        return "\n".join(Lines)
 
 class Parser:
-    def __init__(self, Tokens):
-        self.Tokens = Tokens
-        self.Index = -1
-        self.Sizes = {"8": 0, "16": 1, "32": 2, "64": 3}
+    def __init__(self, Tokens, FileName="", Cache=None, Relocatable=False, IncludePaths=(), Stats=None, Optimize=0, Profile=None):
+        # Stack of token streams, one per file being parsed. %include pushes
+        # the included file's stream which is popped again at its Eof.
+        self.Streams = [iter(Tokens)]
+        self.Files = [os.path.realpath(FileName) if FileName else ""]
+        self.Sources = [self.Files[0]] if FileName else [] # Every file read, in include order
+        self.Missing = [] # Paths an include that wasn't found was looked for at
+        self.IncludePaths = list(IncludePaths)
+        self.Once = set() # Files that asked to be included only once
+        self.Cache = Cache
+        self.Stats = Stats
+        self.Prefetch = None # Prefetcher that may already hold included files
+        self.Token = None
+        self.TokenFile = self.Files[0]
+        self.Next = None
+        self.NextFile = self.Files[0]
         self.Registers = {"sp": 11, "fp": 12, "ip": 13, "flags": 14, "pgtbl": 15, "ivtbl": 16}
         for i in range(11):
             self.Registers[f"g{i}"] = i
-        self.Program = []
-        self.Address = 0
+        self.Program = bytearray()
+        self.Reserved = 0 # Reserved bytes after the end of Program, only materialised when data follows
+        self.Segments = [(0, 0)] # (Address, Start) per ORG, Start is where its bytes begin in Program
         self.Labels = {}
+        self.Constants = {} # EQU and %define values, folded or still an expression
+        self.Fixups = [] # (Offset, Size, Expression, Addend)
+        self.Relocatable = Relocatable
+        self.Optimize = Optimize
+        self.Profile = Profile # Label: count, code is laid out by it after the peephole pass
+        self.LaidOut = None # (Hot blocks, bytes, cold blocks, bytes, pinned blocks)
+        self.Recording = bool(Optimize) or Profile is not None
+        # With -O1 or a profile every instruction is also recorded:
+        # (Offset, Length, Base, OpCode, Size, SrcMode, Src, DstMode, Dst, Flags)
+        # Flags holds the condition byte for jumps. LabelOffsets has the
+        # offset in Program each label was defined at.
+        self.Code = []
+        self.LabelOffsets = {}
+        self.ConstSpans = [] # (Low, High) offsets whose length a count or address was computed from
+        self.Optimized = {} # Rule: [Instructions, Bytes removed]
+        self.Globals = set()
+        self.Externs = set()
 
     def Error(self, Message):
-        print(f"Error at {self.Tokens[self.Index][2][0]}:{self.Tokens[self.Index][2][1]}: {Message}")
-        exit(1)
+        Row, Column = self.Token[2]
+        raise AssemblerError(f"Error at {Row}:{Column}: {Message}", Message, self.TokenFile or None, Row, Column)
+
+    def Pull(self):
+        try:
+            Token = next(self.Streams[-1])
+            while Token[0] == TokenType.Eof:
+                if len(self.Streams) == 1:
+                    self.Streams[0] = repeat(Token) # Keep returning the final Eof
+                    return Token
+                self.Streams.pop()
+                self.Files.pop()
+                Token = next(self.Streams[-1])
+        except AssemblerError as Err:
+            if Err.File is None:
+                Err.File = self.Files[-1] or None
+            raise
+        return Token
+
+    def Tokenize(self, Text, Path):
+        if self.Cache is None and self.Stats is None:
+            return TokenizeStream(Text)
+        try:
+            return iter(TokenizeFile(Text, Path, self.Cache, self.Stats))
+        except AssemblerError as Err:
+            Err.File = Path
+            raise
 
     def Eat(self, Type):
-        self.Index += 1
-        if self.Tokens[self.Index][0] != Type:
+        Token = self.Consume()
+        if Token[0] != Type:
             self.Error(f"Unexpected token.")
-        return self.Tokens[self.Index]
+        return Token
 
     def Consume(self):
-        self.Index += 1
-        return self.Tokens[self.Index]
+        if self.Next is None:
+            self.Token = self.Pull()
+            self.TokenFile = self.Files[-1]
+        else:
+            self.Token = self.Next
+            self.TokenFile = self.NextFile
+            self.Next = None
+        return self.Token
 
     def Peek(self):
-        return self.Tokens[self.Index + 1]
+        if self.Next is None:
+            self.Next = self.Pull()
+            self.NextFile = self.Files[-1]
+        return self.Next
+
+    def FindInclude(self, Name):
+        # Relative to the including file first, then the include paths in order
+        Directories = [os.path.dirname(self.TokenFile)] + self.IncludePaths
+        Path = FindFile(Name, Directories)
+        if Path is None:
+            self.Missing += [os.path.realpath(os.path.join(Directory, Name)) for Directory in Directories]
+        return Path
 
     def GetRegister(self, Register):
         return self.Registers[Register]
 
+    def GetLabel(self, Label):
+        # Objects are relocated by the linker, so every label use becomes a fixup
+        Value = self.Constants.get(Label)
+        if isinstance(Value, int):
+            return Value
+        if self.Relocatable or self.Recording or Label not in self.Labels:
+            return Label # Optimized code still moves, so its labels are patched late
+        return self.Labels[Label]
+
+    def Fold(self, Op, Left, Right):
+        if isinstance(Left, int) and isinstance(Right, int):
+            try:
+                return Operators[Op](Left, Right)
+            except (ZeroDivisionError, ValueError):
+                self.Error(f"Can't evaluate {Left} {Op} {Right}.")
+        return (Op, Left, Right)
+
+    def ParseAtom(self):
+        Token = self.Consume()
+        if Token[0] == TokenType.Num:
+            return self.GetInt(Token[1])
+        elif Token[0] == TokenType.Id:
+            return self.GetLabel(Token[1])
+        elif Token[0] == TokenType.Minus:
+            return self.Fold("-", 0, self.ParseAtom())
+        elif Token[0] == TokenType.LParen:
+            Value = self.ParseExpr()
+            self.Eat(TokenType.RParen)
+            return Value
+        self.Error("Expected a number, label or expression.")
+
+    def ParseExpr(self, Level=1, Split=False):
+        # Expressions are folded while they are parsed. Whatever still needs a
+        # symbol that isn't known yet stays a tree of (Op, Left, Right) with
+        # symbol names as leaves and is folded by ParsePostamble.
+        # Split stops at a top-level '+', see HandleAddress.
+        Left = self.ParseAtom()
+        Op = BinaryOps.get(self.Peek()[0])
+        while Op is not None and Op[0] >= Level:
+            if Split and Op[1] == "+":
+                break
+            self.Consume()
+            Left = self.Fold(Op[1], Left, self.ParseExpr(Op[0] + 1))
+            Op = BinaryOps.get(self.Peek()[0])
+        return Left
+
+    def ParseConst(self):
+        # Counts and addresses that decide the layout must be known right away
+        Value = self.ParseExpr()
+        if not isinstance(Value, int) and self.Recording and not self.Relocatable:
+            Value = self.ResolveConst(Value)
+        if not isinstance(Value, int):
+            self.Error("Expected a constant expression.")
+        return Value
+
+    def ResolveConst(self, Expr):
+        # Recorded code keeps every label use symbolic, here the labels that
+        # are defined already get their value like they would without -O1 or
+        # --profile. The code the value depends on, between the labels or up
+        # to the label for an address, must then keep its length and place.
+        try:
+            Value = self.Evaluate(Expr)
+        except AssemblerError as Err:
+            if Err.Message.startswith("Undefined label"):
+                return Expr
+            self.Error(Err.Message)
+        Offsets = [self.LabelOffsets[Name] for Name in self.LabelsIn(Expr)]
+        try:
+            Relative = sum(self.Linearize(Expr)[1].values()) == 0
+        except AssemblerError:
+            Relative = False
+        if Offsets:
+            self.ConstSpans.append((min(Offsets) if Relative else 0, max(Offsets)))
+        return Value
+
     def GetInt(self, Int):
         if len(Int) > 2 and Int[1].lower() == 'x':
             return int(Int, 16)
@@ -209,29 +812,78 @@ class Parser:
             return int(Int, 2)
         return int(Int)
 
+    def AddFixup(self, Expr, Size):
+        # Forward references are patched by ParsePostamble once every label is known
+        self.Fixups.append((len(self.Program), Size, Expr, 0))
+
+    def Record(self, Mnemonic, Start, SrcMode, Src, DstMode, Dst, Flags):
+        Base = self.Here() - self.Size()
+        self.Code.append((Start, len(self.Program) - Start, Base, Mnemonic[2], Mnemonic[3], SrcMode, Src, DstMode, Dst, Flags))
+
+    def Here(self):
+        Address, Start = self.Segments[-1]
+        return Address + len(self.Program) + self.Reserved - Start
+
+    def Size(self):
+        return len(self.Program) + self.Reserved
+
+    def FlushReserved(self):
+        # Data follows the reservation, so it has to exist in the image after all
+        self.Program += bytes(self.Reserved)
+        self.Reserved = 0
+
     def Write8(self, Value):
+        if self.Reserved:
+            self.FlushReserved()
         if isinstance(Value, int):
             self.Program.append(Value & 0xFF)
         else:
-            self.Program.extend([Value, 1])
+            self.AddFixup(Value, 1)
+            self.Program.append(0)
 
     def Write16(self, Value):
-        if isinstance(Value, int):
-            self.Program.extend(Value.to_bytes(2, byteorder="little"))
-        else:
-            self.Program.extend([Value, 2])
+        if self.Reserved:
+            self.FlushReserved()
+        if not isinstance(Value, int):
+            self.AddFixup(Value, 2)
+            Value = 0
+        self.Program += Packers[2].pack(Value & 0xFFFF)
 
     def Write32(self, Value):
-        if isinstance(Value, int):
-            self.Program.extend(Value.to_bytes(4, byteorder="little"))
-        else:
-            self.Program.extend([Value, 4, 0, 0])
+        if self.Reserved:
+            self.FlushReserved()
+        if not isinstance(Value, int):
+            self.AddFixup(Value, 4)
+            Value = 0
+        self.Program += Packers[4].pack(Value & 0xFFFFFFFF)
 
     def Write64(self, Value):
-        if isinstance(Value, int):
-            self.Program.extend(Value.to_bytes(8, byteorder="little"))
-        else:
-            self.Program.extend([Value, 8, 0, 0, 0, 0, 0, 0])
+        if self.Reserved:
+            self.FlushReserved()
+        if not isinstance(Value, int):
+            self.AddFixup(Value, 8)
+            Value = 0
+        self.Program += Packers[8].pack(Value & 0xFFFFFFFFFFFFFFFF)
+
+    def WriteFile(self, Path, Offset, Length):
+        # The file is mapped and copied into the image in one go
+        try:
+            File = open(Path, "rb")
+        except OSError as Err:
+            self.Error(f"Can't read {os.path.basename(Path)}: {Err.strerror}.")
+        with File:
+            FileSize = os.fstat(File.fileno()).st_size
+            if Length is None:
+                Length = max(FileSize - Offset, 0)
+            if Offset + Length > FileSize:
+                self.Error(f"INCBIN range {Offset}+{Length} is past the end of {os.path.basename(Path)} ({FileSize} bytes).")
+            if Length == 0:
+                return
+            if self.Reserved:
+                self.FlushReserved()
+            with mmap.mmap(File.fileno(), 0, access=mmap.ACCESS_READ) as Map:
+                with memoryview(Map) as View, View[Offset:Offset + Length] as Data:
+                    self.Program += Data
 
     def Write(self, Value, Size):
         if Size == 0:
@@ -243,107 +895,60 @@ class Parser:
         else:
             self.Write64(Value)
 
-    def Instruction(self, Size, OpCode, Src, Dst, Flags):
-        Instruction = Size << 14
-        Instruction |= OpCode.value << 8
-        Instruction |= Src << 6
-        Instruction |= Dst << 4
-        Instruction |= Flags
-        return Instruction
+    def HandleAddress(self, InstFlags, OffFlag, RegOffFlag):
+        # After '[': a register or an expression, then an optional offset. A
+        # top-level '+' always starts the offset, so [LABEL+4] keeps its
+        # encoding with a separate offset field.
+        Off = 0
+        if self.Peek()[0] == TokenType.Reg:
+            IsReg = True
+            Addr = self.GetRegister(self.Consume()[1])
+        else:
+            IsReg = False
+            Addr = self.ParseExpr(Split=True)
+        Sign = self.Peek()[0]
+        if Sign == TokenType.Plus or (IsReg and Sign == TokenType.Minus):
+            self.Consume()
+            InstFlags |= OffFlag
+            if Sign == TokenType.Plus and self.Peek()[0] == TokenType.Reg:
+                InstFlags |= RegOffFlag
+                Off = self.GetRegister(self.Consume()[1])
+            else:
+                Off = self.ParseExpr()
+                if Sign == TokenType.Minus:
+                    Off = self.Fold("-", 0, Off)
+        self.Eat(TokenType.RBrac)
+        return (IsReg, Addr, Off, InstFlags)
 
     def HandleDst(self, InstFlags):
         InstDstTok = self.Consume()
-        InstDst = 0
-        Dst = 0
-        DstOff = 0
         if InstDstTok[0] == TokenType.Reg:
-            InstDst = 0
-            Dst = self.GetRegister(InstDstTok[1])
+            return (0, self.GetRegister(InstDstTok[1]), 0, InstFlags)
         elif InstDstTok[0] == TokenType.LBrac:
-            InstAddrTok = self.Consume()
-            if InstAddrTok[0] == TokenType.Reg:
-                InstDst = 1
-                Dst = self.GetRegister(InstAddrTok[1])
-            elif InstAddrTok[0] == TokenType.Num or InstAddrTok[0] == TokenType.Id:
-                InstDst = 2
-                if InstAddrTok[0] == TokenType.Id:
-                    Dst = InstAddrTok[1]
-                else:
-                    Dst = self.GetInt(InstAddrTok[1])
-            else:
-                self.Error("Invalid addressing.")
-            InstNextTok = self.Consume()
-            if InstNextTok[0] == TokenType.Plus:
-                InstFlags |= 0b0010
-                InstNextTok = self.Consume()
-                if InstNextTok[0] == TokenType.Reg:
-                    InstFlags |= 0b1000
-                    DstOff = self.GetRegister(InstNextTok[1])
-                elif InstNextTok[0] == TokenType.Num:
-                    DstOff = self.GetInt(InstNextTok[1])
-                else:
-                    self.Error("Invalid offset.")
-                self.Eat(TokenType.RBrac)
-            else:
-                if InstNextTok[0] != TokenType.RBrac:
-                    self.Error("Unexpected token.")
-        else:
-            self.Error("Unexpected destination.")
-        return (InstDst, Dst, DstOff, InstFlags)
+            IsReg, Dst, DstOff, InstFlags = self.HandleAddress(InstFlags, 0b0010, 0b1000)
+            return (1 if IsReg else 2, Dst, DstOff, InstFlags)
+        self.Error("Unexpected destination.")
 
     def HandleSrc(self, InstFlags):
-        InstSrcTok = self.Consume()
-        InstSrc = 0
-        Src = 0
-        SrcOff = 0
+        InstSrcTok = self.Peek()
         if InstSrcTok[0] == TokenType.Reg:
-            InstSrc = 0
-            Src = self.GetRegister(InstSrcTok[1])
+            self.Consume()
+            return (0, self.GetRegister(InstSrcTok[1]), 0, InstFlags)
         elif InstSrcTok[0] == TokenType.LBrac:
-            InstAddrTok = self.Consume()
-            if InstAddrTok[0] == TokenType.Reg:
-                InstSrc = 1
-                Src = self.GetRegister(InstAddrTok[1])
-            elif InstAddrTok[0] == TokenType.Num or InstAddrTok[0] == TokenType.Id:
-                InstSrc = 3
-                if InstAddrTok[0] == TokenType.Id:
-                    Src = InstAddrTok[1]
-                else:
-                    Src = self.GetInt(InstAddrTok[1])
-            else:
-                self.Error("Invalid addressing")
-            InstNextTok = self.Consume()
-            if InstNextTok[0] == TokenType.Plus:
-                InstFlags |= 0b0001
-                InstNextTok = self.Consume()
-                if InstNextTok[0] == TokenType.Reg:
-                    InstFlags |= 0b0100
-                    SrcOff = self.GetRegister(InstNextTok[1])
-                elif InstNextTok[0] == TokenType.Num:
-                    SrcOff = self.GetInt(InstNextTok[1])
-                else:
-                    self.Error("Invalid offset.")
-                self.Eat(TokenType.RBrac)
-            else:
-                if InstNextTok[0] != TokenType.RBrac:
-                    self.Error("Unexpected token.")
-        elif InstSrcTok[0] == TokenType.Num or InstSrcTok[0] == TokenType.Id:
-            InstSrc = 2
-            if InstSrcTok[0] == TokenType.Id:
-                Src = InstSrcTok[1]
-            else:
-                Src = self.GetInt(InstSrcTok[1])
-        return (InstSrc, Src, SrcOff, InstFlags)
+            self.Consume()
+            IsReg, Src, SrcOff, InstFlags = self.HandleAddress(InstFlags, 0b0001, 0b0100)
+            return (1 if IsReg else 3, Src, SrcOff, InstFlags)
+        return (2, self.ParseExpr(), 0, InstFlags)
 
-    def HandleOpInst(self, Token, OpCode, TwoLetterInst):
-        InstSize = self.Sizes[Token[1][(2 if TwoLetterInst else 3):5]]
+    def HandleOpInst(self, Token, Mnemonic):
+        Start = self.Size()
+        InstSize = Mnemonic[3]
         InstFlags = 0
         InstDst, Dst, DstOff, InstFlags = self.HandleDst(InstFlags)
         self.Eat(TokenType.Comma)
         InstSrc, Src, SrcOff, InstFlags = self.HandleSrc(InstFlags)
 
-        Instruction = self.Instruction(InstSize, OpCode, InstSrc, InstDst, InstFlags)
-        self.Write16(Instruction)
+        self.Write16(Mnemonic[4] | (InstSrc << 6) | (InstDst << 4) | InstFlags)
 
         if InstFlags & 0b0001:
             if InstFlags & 0b0100:
@@ -366,14 +971,16 @@ class Parser:
             self.Write8(Dst)
         else:
             self.Write64(Dst)
+        if self.Recording:
+            self.Record(Mnemonic, Start, InstSrc, Src, InstDst, Dst, InstFlags)
 
-    def HandlePush(self, Token):
-        InstSize = self.Sizes[Token[1][4:7]]
+    def HandlePush(self, Token, Mnemonic):
+        Start = self.Size()
+        InstSize = Mnemonic[3]
         InstFlags = 0
         InstSrc, Src, SrcOff, InstFlags = self.HandleSrc(InstFlags)
 
-        Instruction = self.Instruction(InstSize, OpCodes.Push, InstSrc, 0, InstFlags)
-        self.Write16(Instruction)
+        self.Write16(Mnemonic[4] | (InstSrc << 6) | InstFlags)
 
         if InstFlags & 0b0001:
             if InstFlags & 0b0100:
@@ -386,14 +993,15 @@ class Parser:
             self.Write(Src, InstSize)
         else:
             self.Write64(Src)
+        if self.Recording:
+            self.Record(Mnemonic, Start, InstSrc, Src, None, None, InstFlags)
 
-    def HandlePop(self, Token):
-        InstSize = self.Sizes[Token[1][3:6]]
+    def HandlePop(self, Token, Mnemonic):
+        Start = self.Size()
         InstFlags = 0
         InstDst, Dst, DstOff, InstFlags = self.HandleDst(InstFlags)
 
-        Instruction = self.Instruction(InstSize, OpCodes.Pop, 0, InstDst, InstFlags)
-        self.Write16(Instruction)
+        self.Write16(Mnemonic[4] | (InstDst << 4) | InstFlags)
 
         if InstFlags & 0b0010:
             if InstFlags & 0b1000:
@@ -404,77 +1012,71 @@ class Parser:
             self.Write8(Dst)
         else:
             self.Write64(Dst)
+        if self.Recording:
+            self.Record(Mnemonic, Start, None, None, InstDst, Dst, InstFlags)
 
-    def HandleOrg(self, Token):
-        AddressTok = self.Eat(TokenType.Num)
-        self.Address = self.GetInt(AddressTok[1])
+    def HandleOrg(self, Token, Mnemonic):
+        if self.Relocatable:
+            self.Error("ORG is not allowed in object files, pass --org to ald.py instead.")
+        Address = self.ParseConst()
+        if Address < 0:
+            self.Error("ORG address can't be negative.")
+        if self.Size() == self.Segments[-1][1]:
+            self.Segments[-1] = (Address, self.Size()) # Nothing placed at the old address yet
+        elif Address != self.Here():
+            if self.Reserved:
+                self.FlushReserved()
+            self.Segments.append((Address, self.Size()))
 
     def HandleLabel(self, NameTok):
         self.Eat(TokenType.Colon)
-        self.Labels[NameTok[1]] = self.Address + len(self.Program)
-
-    def HandleJmp(self, Token):
-        CondFlags = 0
-        if Token[1] == "jc":
-            CondFlags |= 0b00000010
-        elif Token[1] == "jz" or Token[1] == "je":
-            CondFlags |= 0b00000100
-        elif Token[1] == "jne":
-            CondFlags |= 0b00011000
-        elif Token[1] == "jg":
-            CondFlags |= 0b00001000
-        elif Token[1] == "jge":
-            CondFlags |= 0b00001100
-        elif Token[1] == "jl":
-            CondFlags |= 0b00010000
-        elif Token[1] == "jle":
-            CondFlags |= 0b00010100
+        if NameTok[1] in self.Constants:
+            self.Error(f"{NameTok[1]} is already defined as a constant.")
+        self.Labels[NameTok[1]] = self.Here()
+        self.LabelOffsets[NameTok[1]] = self.Size()
+
+    def HandleConstant(self, NameTok):
+        # NAME EQU expression and %define NAME expression
+        if NameTok[1] in self.Constants or NameTok[1] in self.Labels:
+            self.Error(f"{NameTok[1]} is already defined.")
+        self.Constants[NameTok[1]] = self.ParseExpr()
+
+    def HandleJmp(self, Token, Mnemonic):
+        Start = self.Size()
+        CondFlags = Mnemonic[5]
         if self.Peek()[0] == TokenType.Rel:
             self.Consume()
             CondFlags |= 0b00000001
-        LabelTok = self.Consume()
-        Addr = 0
-        if LabelTok[0] == TokenType.Id:
-            Label = LabelTok[1]
-            if Label not in self.Labels:
-                Addr = Label
-            else:
-                Addr = self.Labels[Label]
-        else:
-            Addr = self.GetInt(LabelTok[1])
-        Flags = 0b0000
+        Addr = self.ParseExpr()
         Src = 2
-        Instruction = self.Instruction(3, OpCodes.Jmp, Src, 0, Flags)
-        self.Write16(Instruction)
+        self.Write16(Mnemonic[4] | (Src << 6))
         self.Write8(CondFlags)
         self.Write64(Addr)
+        if self.Recording:
+            self.Record(Mnemonic, Start, Src, Addr, None, None, CondFlags)
 
-    def HandleCall(self, Token):
-        LabelTok = self.Consume()
+    def HandleCall(self, Token, Mnemonic):
+        Start = self.Size()
         # TODO: Handle Reg
-        if LabelTok[0] == TokenType.Id:
-            Label = LabelTok[1]
-            if Label not in self.Labels:
-                Addr = Label
-            else:
-                Addr = self.Labels[Label]
-        Flags = 0b0000
+        Addr = self.ParseExpr()
         Src = 2
-        Instruction = self.Instruction(3, OpCodes.Call, Src, 0, Flags)
-        self.Write16(Instruction)
+        self.Write16(Mnemonic[4] | (Src << 6))
         self.Write64(Addr)
+        if self.Recording:
+            self.Record(Mnemonic, Start, Src, Addr, None, None, 0)
 
-    def HandleSimpleInst(self, Token, OpCode):
-        Instruction = self.Instruction(3, OpCode, 0, 0, 0)
-        self.Write16(Instruction)
+    def HandleSimpleInst(self, Token, Mnemonic):
+        Start = self.Size()
+        self.Write16(Mnemonic[4])
+        if self.Recording:
+            self.Record(Mnemonic, Start, None, None, None, None, 0)
 
-    def HandleNot(self, Token):
-        InstSize = self.Sizes[Token[1][3:6]]
+    def HandleNot(self, Token, Mnemonic):
+        Start = self.Size()
         InstFlags = 0
         InstDst, Dst, DstOff, InstFlags = self.HandleDst(InstFlags)
 
-        Instruction = self.Instruction(InstSize, OpCodes.Not, 0, InstDst, InstFlags)
-        self.Write16(Instruction)
+        self.Write16(Mnemonic[4] | (InstDst << 4) | InstFlags)
 
         if InstFlags & 0b0010:
             if InstFlags & 0b1000:
@@ -485,12 +1087,14 @@ class Parser:
             self.Write8(Dst)
         else:
             self.Write64(Dst)
+        if self.Recording:
+            self.Record(Mnemonic, Start, None, None, InstDst, Dst, InstFlags)
 
-    def HandleInt(self, Token):
+    def HandleInt(self, Token, Mnemonic):
+        Start = self.Size()
         InstSrc, Src, SrcOff, InstFlags = self.HandleSrc(0)
 
-        Instruction = self.Instruction(0, OpCodes.Int, InstSrc, 0, InstFlags)
-        self.Write16(Instruction)
+        self.Write16(Mnemonic[4] | (InstSrc << 6) | InstFlags)
 
         if InstFlags & 0b0001:
             if InstFlags & 0b0100:
@@ -501,116 +1105,542 @@ class Parser:
             self.Write8(Src)
         else:
             self.Write64(Src)
+        if self.Recording:
+            self.Record(Mnemonic, Start, InstSrc, Src, None, None, InstFlags)
     
-    def HandleDefine(self, Token):
-        WSize = self.Sizes[Token[1][1:3]]
-        Data = self.Consume()
-        Def = 0
-        if Data[0] == TokenType.Id:
-            Label = Data[1]
-            if Label not in self.Labels:
-                Def = Label
+    def HandleDefine(self, Token, Mnemonic, Count=1):
+        # D8 1, "str", LABEL, ... is packed into one block, TIMES repeats it
+        Width = 1 << Mnemonic[3]
+        Values = []
+        Labels = [] # (Index in Values, Label)
+        while True:
+            if self.Peek()[0] == TokenType.Str:
+                Values.extend(map(ord, self.Consume()[1]))
             else:
-                Def = self.Labels[Label]
-        elif Data[0] == TokenType.Str:
-            String = Data[1]
-            for Char in String:
-                self.Write(ord(Char), WSize)
-            return
-        else:
-            Def = self.GetInt(Data[1])
-        self.Write(Def, WSize)
+                Def = self.ParseExpr()
+                if not isinstance(Def, int):
+                    Labels.append((len(Values), Def))
+                    Def = 0
+                Values.append(Def)
+            if self.Peek()[0] != TokenType.Comma:
+                break
+            self.Consume()
+        Mask = Masks[Width]
+        Values = [Value & Mask for Value in Values]
+        Block = struct.pack(f"<{len(Values)}{PackCodes[Width]}", *Values)
+        if self.Reserved:
+            self.FlushReserved()
+        Start = len(self.Program)
+        self.Program += Block * Count
+        for Copy in range(Count if Labels else 0):
+            for Index, Label in Labels:
+                self.Fixups.append((Start + Copy * len(Block) + Index * Width, Width, Label, 0))
+
+    def HandleTimes(self, Token, Mnemonic):
+        Count = self.ParseConst()
+        if Count < 0:
+            self.Error("TIMES count can't be negative.")
+        Token = self.Consume()
+        Mnemonic = Mnemonics.get(Token[1])
+        if Mnemonic is None or Mnemonic[0] != Token[0] or Token[0] != TokenType.Define:
+            self.Error("TIMES can only repeat data directives (D8, D16, D32, D64).")
+        self.HandleDefine(Token, Mnemonic, Count)
 
-    def HandleRes(self, Token):
-        WSize = self.Sizes[Token[1][3:5]]
-        Count = self.GetInt(self.Eat(TokenType.Num)[1])
-        self.Program.extend([0] * ((1 << WSize) * Count))
+    def HandleRes(self, Token, Mnemonic):
+        WSize = Mnemonic[3]
+        Count = self.ParseConst()
+        if Count < 0:
+            self.Error("RES count can't be negative.")
+        self.Reserved += (1 << WSize) * Count
 
     def HandlePreProc(self, Token):
         if Token[1] == "include":
+            Start = time.perf_counter()
+            if self.Stats is not None:
+                self.Stats.Mark("Parse") # Parsing up to here, the include is charged apart
             Name = self.Eat(TokenType.Str)
-            try:
-                File = open(Name[1], "r")
-            except FileNotFoundError:
+            Path = self.FindInclude(Name[1])
+            if Path is None:
                 self.Error(f"Couldn't find file {Name[1]}")
-            Tokens = Tokenize(File.read())
-            self.Tokens.pop(len(self.Tokens) - 1) # Remove EOF
-            Tokens.pop(len(Tokens) - 1) # Remove Eof
-            self.Tokens[self.Index + 1:self.Index + 1] = Tokens
-            self.Tokens.append((TokenType.Eof, "", (0, 0)))
+            if Path in self.Once:
+                return
+            if Path not in self.Sources:
+                self.Sources.append(Path)
+            Tokens = self.Prefetch.Take(Path) if self.Prefetch else None
+            if Tokens is None:
+                try:
+                    Text = ReadSource(Path)
+                except AssemblerError as Err:
+                    self.Error(f"{Name[1]}: {Err.Message}")
+            if self.Stats is not None:
+                self.Stats.Time("Include", Start)
+            if Tokens is None:
+                Tokens = self.Tokenize(Text, Path)
+            else:
+                if self.Stats is not None:
+                    self.Stats.Tokens(Path, Tokens)
+                Tokens = iter(Tokens)
+            if self.Next is not None:
+                self.Streams[-1] = chain([self.Next], self.Streams[-1])
+                self.Next = None
+            self.Streams.append(Tokens)
+            self.Files.append(Path)
+        elif Token[1] == "incbin":
+            Name = self.Eat(TokenType.Str)
+            Offset = 0
+            Length = None
+            if self.Peek()[0] == TokenType.Comma:
+                self.Consume()
+                Offset = self.ParseConst()
+                if Offset < 0:
+                    self.Error("INCBIN offset can't be negative.")
+                if self.Peek()[0] == TokenType.Comma:
+                    self.Consume()
+                    Length = self.ParseConst()
+                    if Length < 0:
+                        self.Error("INCBIN length can't be negative.")
+            Path = self.FindInclude(Name[1])
+            if Path is None:
+                self.Error(f"Couldn't find file {Name[1]}")
+            if Path not in self.Sources:
+                self.Sources.append(Path)
+            self.WriteFile(Path, Offset, Length)
+        elif Token[1] == "define":
+            self.HandleConstant(self.Eat(TokenType.Id))
+        elif Token[1] == "global":
+            self.Globals.add(self.Eat(TokenType.Id)[1])
+        elif Token[1] == "extern":
+            self.Externs.add(self.Eat(TokenType.Id)[1])
+        elif Token[1] == "pragma":
+            Pragma = self.Eat(TokenType.Id)
+            if Pragma[1].lower() == "once":
+                self.Once.add(self.Files[-1])
+            else:
+                self.Error(f"Unknown pragma {Pragma[1]}.")
+
+    def NextKept(self, Index, Removed):
+        # The instruction that runs after Code[Index] once Removed is gone,
+        # None when something that isn't code follows. Also returns the
+        # offsets in between, which must not be jumped to.
+        Code = self.Code
+        End = Code[Index][0] + Code[Index][1]
+        Base = Code[Index][2]
+        Between = []
+        Index += 1
+        while Index < len(Code) and Code[Index][0] == End and Code[Index][2] == Base: # An ORG breaks the flow
+            Between.append(End)
+            if Index not in Removed:
+                return Index, Between
+            End += Code[Index][1]
+            Index += 1
+        return None, Between
+
+    def JumpTarget(self, Inst):
+        # Offset of the label a plain JMP/Jcc goes to, None when it isn't one
+        Offset, Length, Base, OpCode, Size, SrcMode, Src, DstMode, Dst, Flags = Inst
+        if OpCode != OpCodes.Jmp or Flags & 0b1 or not isinstance(Src, str) or Src not in self.LabelOffsets:
+            return None
+        if self.Labels[Src] - self.LabelOffsets[Src] != Base:
+            return None # An ORG sits in between
+        return self.LabelOffsets[Src]
+
+    def RelSpans(self):
+        # (Low, High) offsets between each REL jump and where it lands, the
+        # code in there can't change length without breaking the jump
+        Spans = []
+        for Inst in self.Code:
+            if Inst[3] == OpCodes.Jmp and Inst[9] & 0b1:
+                Next = Inst[0] + Inst[1]
+                Names = self.LabelsIn(Inst[6])
+                try:
+                    Ends = [self.LabelOffsets[Name] for Name in Names] if Names else [Next + self.Evaluate(Inst[6])]
+                except AssemblerError:
+                    continue # An extern, the linker places it
+                Spans += [(min(Next, End), max(Next, End)) for End in Ends]
+        return Spans
+
+    def FixupSpans(self):
+        # (Low, High) offsets a fixup depends on the layout of: from a label
+        # to where label + constant points, or between the labels of an
+        # expression that uses more than one
+        Spans = []
+        for Offset, Size, Expr, Addend in self.Fixups:
+            Names = self.LabelsIn(Expr)
+            if not Names:
+                continue
+            try:
+                Constant, Symbols = self.Linearize(Expr)
+            except AssemblerError:
+                Symbols = {}
+            if len(Names) == 1 and Symbols == {Name: 1 for Name in Names}:
+                At = self.LabelOffsets[next(iter(Names))]
+                Spans.append((min(At, At + Constant + Addend), max(At, At + Constant + Addend)))
+            else:
+                Offsets = [self.LabelOffsets[Name] for Name in Names]
+                Spans.append((min(Offsets), max(Offsets) + 1))
+        return Spans
+
+    def Peephole(self):
+        # -O1: drops instructions without an effect and threads jumps, then
+        # closes the gaps and moves labels and fixups along with the code
+        Code = self.Code
+        ByOffset = {Code[i][0]: i for i in range(len(Code))}
+        Spans = []
+        for Low, High in sorted(self.RelSpans() + self.ConstSpans + self.FixupSpans()):
+            if Spans and Low <= Spans[-1][1]:
+                Spans[-1] = (Spans[-1][0], max(Spans[-1][1], High))
+            else:
+                Spans.append((Low, High))
+        SpanStarts = [Low for Low, High in Spans]
+        def Spanned(i):
+            Span = bisect_left(SpanStarts, Code[i][0] + Code[i][1]) - 1
+            return Span >= 0 and Code[i][0] < Spans[Span][1]
+        InSpan = {i for i in range(len(Code)) if Spanned(i)}
+        LabelAt = set(self.LabelOffsets.values())
+        FixupAt = {self.Fixups[i][0]: i for i in range(len(self.Fixups))}
+        Removed = {}
+        Changed = True
+        while Changed:
+            Changed = False
+            for i in range(len(Code)):
+                if i in Removed or i in InSpan:
+                    continue
+                Offset, Length, Base, OpCode, Size, SrcMode, Src, DstMode, Dst, Flags = Code[i]
+                Next, Between = self.NextKept(i, Removed)
+                Rule = None
+                if OpCode == OpCodes.Mov and SrcMode == 0 and DstMode == 0 and Src == Dst and Flags == 0:
+                    Rule = "mov to itself"
+                elif OpCode == OpCodes.Push and SrcMode == 0 and Flags == 0 and Next is not None:
+                    Pop = Code[Next]
+                    if Next not in InSpan and Pop[3] == OpCodes.Pop and Pop[4] == Size and Pop[7] == 0 and Pop[8] == Src and Pop[9] == 0 and LabelAt.isdisjoint(Between):
+                        Removed[Next] = "push/pop"
+                        Rule = "push/pop"
+                elif OpCode in (OpCodes.Add, OpCodes.Sub, OpCodes.Or, OpCodes.Xor, OpCodes.Shl, OpCodes.Shr):
+                    # Only the flags change, and the CMP that follows sets them again
+                    if SrcMode == 2 and Src == 0 and DstMode == 0 and Flags == 0 and Next is not None and Code[Next][3] == OpCodes.Cmp:
+                        Rule = f"{OpCode.name.lower()} 0"
+                elif OpCode == OpCodes.Jmp:
+                    Target = self.JumpTarget(Code[i])
+                    if Target is not None and Target == Offset + Length + sum(Code[ByOffset[At]][1] for At in Between if ByOffset[At] in Removed):
+                        Rule = "jump to next"
+                    elif Target is not None:
+                        # Follow a chain of unconditional jumps to its end,
+                        # a chain that loops is left alone
+                        Label = Src
+                        Seen = {Label}
+                        At = ByOffset.get(Target)
+                        while At is not None and At not in Removed and Code[At][3] == OpCodes.Jmp and Code[At][9] == 0:
+                            NextTarget = self.JumpTarget(Code[At])
+                            if NextTarget is None:
+                                break
+                            if Code[At][6] in Seen:
+                                Label = Src
+                                break
+                            Label = Code[At][6]
+                            Seen.add(Label)
+                            At = ByOffset.get(NextTarget)
+                        if Label != Src:
+                            Code[i] = (Offset, Length, Base, OpCode, Size, SrcMode, Label, DstMode, Dst, Flags)
+                            Fixup = FixupAt[Offset + 3]
+                            self.Fixups[Fixup] = self.Fixups[Fixup][:2] + (Label,) + self.Fixups[Fixup][3:]
+                            Entry = self.Optimized.setdefault("jump threaded", [0, 0])
+                            Entry[0] += 1
+                            Changed = True
+                if Rule is not None:
+                    Removed[i] = Rule
+                    Changed = True
+        if not Removed:
+            return
+        for i in Removed:
+            Entry = self.Optimized.setdefault(Removed[i], [0, 0])
+            Entry[0] += 1
+            Entry[1] += Code[i][1]
+
+        # Close the gaps, Shift(X) is how far anything at offset X moves back
+        Gaps = sorted((Code[i][0], Code[i][1]) for i in Removed)
+        Starts = [Start for Start, Length in Gaps]
+        Before = [0]
+        for Start, Length in Gaps:
+            Before.append(Before[-1] + Length)
+        Shift = lambda Offset: Before[bisect_left(Starts, Offset)]
+        Program = bytearray()
+        Last = 0
+        for Start, Length in Gaps:
+            Program += self.Program[Last:Start]
+            Last = Start + Length
+        Program += self.Program[Last:]
+        self.Program = Program
+        Fixups = []
+        for Offset, Size, Expr, Addend in self.Fixups:
+            Gap = bisect_right(Starts, Offset) - 1
+            if Gap >= 0 and Offset < Gaps[Gap][0] + Gaps[Gap][1]:
+                continue # Part of a removed instruction
+            Fixups.append((Offset - Shift(Offset), Size, Expr, Addend))
+        self.Fixups = Fixups
+        # Segments keep their addresses, so a label only moves back by what
+        # was removed in front of it in its own segment
+        Segments = self.Segments
+        SegmentStarts = [Start for Address, Start in Segments]
+        def Moved(Offset, Base):
+            i = bisect_right(SegmentStarts, Offset) - 1
+            if i and Offset == SegmentStarts[i] and Segments[i][0] - Offset != Base:
+                i -= 1 # At the end of the segment before
+            return Shift(Offset) - Shift(SegmentStarts[i])
+        for Name, Offset in self.LabelOffsets.items():
+            self.Labels[Name] -= Moved(Offset, self.Labels[Name] - Offset)
+            self.LabelOffsets[Name] = Offset - Shift(Offset)
+        self.Code = [(Code[i][0] - Shift(Code[i][0]), Code[i][1], Code[i][2] + Shift(Code[i][0]) - Moved(Code[i][0], Code[i][2])) + Code[i][3:]
+                     for i in range(len(Code)) if i not in Removed]
+        self.Segments = [(Address, Start - Shift(Start)) for Address, Start in Segments]
+
+    def LabelsIn(self, Expr, Seen=()):
+        if isinstance(Expr, int):
+            return set()
+        elif isinstance(Expr, str):
+            if Expr in self.Labels:
+                return {Expr}
+            if Expr in self.Constants and Expr not in Seen:
+                return self.LabelsIn(self.Constants[Expr], Seen + (Expr,))
+            return set()
+        return self.LabelsIn(Expr[1], Seen) | self.LabelsIn(Expr[2], Seen)
+
+    def ApplyProfile(self):
+        # --profile: splits the code into blocks that start at a label and end
+        # with JMP or RET, so nothing falls into or out of them. Blocks the
+        # profile counts move, hottest first, to where the first block was,
+        # blocks it doesn't count move to the end. A block stays where it is
+        # when it holds the entry point, a REL jump or a REL jump target, or
+        # when an expression depends on the distance between two places.
+        Code = self.Code
+        if len({self.Labels[Name] - self.LabelOffsets[Name] for Name in self.LabelOffsets}) > 1:
+            self.LaidOut = "skipped, an ORG between labels"
+            return
+        Starts = set(self.LabelOffsets.values())
+        Terminal = lambda Inst: Inst[3] == OpCodes.Ret or (Inst[3] == OpCodes.Jmp and not Inst[9] & ~0b1)
+        Units = []
+        Open = None
+        for i in range(len(Code)):
+            Offset, Length = Code[i][0], Code[i][1]
+            Adjacent = i > 0 and Code[i - 1][0] + Code[i - 1][1] == Offset
+            if not Adjacent:
+                Open = None
+            if Offset in Starts and (not Adjacent or Terminal(Code[i - 1])):
+                Open = Offset
+            if Open is not None and Terminal(Code[i]):
+                Units.append((Open, Offset + Length))
+                Open = None
+        if not Units:
+            self.LaidOut = "skipped, no blocks"
+            return
+        UnitStarts = [Start for Start, End in Units]
+        def UnitOf(Offset):
+            Unit = bisect_right(UnitStarts, Offset) - 1
+            return Unit if Unit >= 0 and Offset < Units[Unit][1] else None
+
+        # Spans that must keep their length: label + constant, expressions
+        # with more than one label and REL jumps to where they land
+        Pinned = {UnitOf(0)}
+        Pinned.update(UnitOf(Inst[0]) for Inst in Code if Inst[3] == OpCodes.Jmp and Inst[9] & 0b1)
+        Spans = self.RelSpans() + self.ConstSpans + self.FixupSpans()
+        for Low, High in Spans:
+            if UnitOf(Low) is None or UnitOf(Low) != UnitOf(High):
+                Pinned.update(i for i in range(len(Units)) if Units[i][0] <= High and Low < Units[i][1])
+        Pinned.discard(None)
+
+        Counts = [0] * len(Units)
+        for Name, Offset in self.LabelOffsets.items():
+            if UnitOf(Offset) is not None:
+                Counts[UnitOf(Offset)] += self.Profile.get(Name, 0)
+        Moving = [i for i in range(len(Units)) if i not in Pinned]
+        Hot = sorted((i for i in Moving if Counts[i]), key=lambda i: -Counts[i])
+        Cold = [i for i in Moving if not Counts[i]]
+        if not Hot:
+            self.LaidOut = "skipped, the profile counts no block that can move"
+            return
+
+        # Pieces in the old order, what lies between moving blocks stays in order
+        Pieces = []
+        Last = 0
+        for i in Moving:
+            if Units[i][0] > Last:
+                Pieces.append((Last, Units[i][0]))
+            Pieces.append(Units[i])
+            Last = Units[i][1]
+        if Last < len(self.Program):
+            Pieces.append((Last, len(self.Program)))
+        MovingUnits = set(Units[i] for i in Moving)
+        Fixed = [Piece for Piece in Pieces if Piece not in MovingUnits]
+        Order = []
+        if Fixed and Fixed[0][0] == 0:
+            Order.append(Fixed.pop(0))
+        Order += [Units[i] for i in Hot] + Fixed + [Units[i] for i in Cold]
+        NewStart = {}
+        Program = bytearray()
+        for Start, End in Order:
+            NewStart[Start] = len(Program)
+            Program += self.Program[Start:End]
+        OldStarts = [Start for Start, End in Pieces]
+        def Move(Offset):
+            if Offset >= len(self.Program):
+                return Offset
+            Start = OldStarts[bisect_right(OldStarts, Offset) - 1]
+            return NewStart[Start] + Offset - Start
+        self.Program = Program
+        self.Fixups = [(Move(Fixup[0]),) + Fixup[1:] for Fixup in self.Fixups]
+        for Name, Offset in self.LabelOffsets.items():
+            self.Labels[Name] += Move(Offset) - Offset
+            self.LabelOffsets[Name] = Move(Offset)
+        self.Code = sorted(((Move(Inst[0]),) + Inst[1:] for Inst in Code), key=lambda Inst: Inst[0])
+        self.LaidOut = (len(Hot), sum(Units[i][1] - Units[i][0] for i in Hot),
+                        len(Cold), sum(Units[i][1] - Units[i][0] for i in Cold), len(Pinned))
+
+    def Evaluate(self, Expr, Seen=()):
+        if isinstance(Expr, int):
+            return Expr
+        elif isinstance(Expr, str):
+            if Expr in self.Labels:
+                return self.Labels[Expr]
+            return self.Evaluate(self.GetConstant(Expr, Seen), Seen + (Expr,))
+        Op, Left, Right = Expr
+        Left = self.Evaluate(Left, Seen)
+        Right = self.Evaluate(Right, Seen)
+        try:
+            return Operators[Op](Left, Right)
+        except (ZeroDivisionError, ValueError):
+            raise AssemblerError(f"Error: Can't evaluate {Left} {Op} {Right}.", f"Can't evaluate {Left} {Op} {Right}.")
+
+    def Linearize(self, Expr, Seen=()):
+        # Splits an expression into (Constant, {Symbol: Factor}), the form an
+        # object relocation needs. Fails on anything that isn't linear.
+        if isinstance(Expr, int):
+            return (Expr, {})
+        elif isinstance(Expr, str):
+            if Expr in self.Labels or (Expr in self.Externs and Expr not in self.Constants):
+                return (0, {Expr: 1})
+            return self.Linearize(self.GetConstant(Expr, Seen), Seen + (Expr,))
+        Op, Left, Right = Expr
+        Left = self.Linearize(Left, Seen)
+        Right = self.Linearize(Right, Seen)
+        if Op == "+" or Op == "-":
+            Sign = 1 if Op == "+" else -1
+            Symbols = dict(Left[1])
+            for Name in Right[1]:
+                Symbols[Name] = Symbols.get(Name, 0) + Sign * Right[1][Name]
+            return (Left[0] + Sign * Right[0], Symbols)
+        if Op == "*" and not Right[1]:
+            Left, Right = Right, Left
+        if Op == "*" and not Left[1]:
+            return (Left[0] * Right[0], {Name: Left[0] * Right[1][Name] for Name in Right[1]})
+        if Left[1] or Right[1]:
+            raise AssemblerError("Error: Only a symbol plus a constant can be relocated.", "Only a symbol plus a constant can be relocated.")
+        try:
+            return (Operators[Op](Left[0], Right[0]), {})
+        except (ZeroDivisionError, ValueError):
+            raise AssemblerError(f"Error: Can't evaluate {Left[0]} {Op} {Right[0]}.", f"Can't evaluate {Left[0]} {Op} {Right[0]}.")
+
+    def GetConstant(self, Name, Seen):
+        if Name not in self.Constants:
+            raise AssemblerError(f"Error: Undefined label {Name}.", f"Undefined label {Name}.")
+        if Name in Seen:
+            raise AssemblerError(f"Error: {Name} is defined in terms of itself.", f"{Name} is defined in terms of itself.")
+        return self.Constants[Name]
+
+    def Relocations(self):
+        # Labels of this file move with the section, so a label difference is
+        # a constant and gets patched here. What is left has to be one label
+        # or extern plus a constant to fit an object relocation.
+        Relocs = []
+        for Offset, Size, Expr, Addend in self.Fixups:
+            Constant, Symbols = self.Linearize(Expr)
+            Constant += Addend
+            Bases = 0
+            Externs = []
+            for Name in Symbols:
+                if Name in self.Labels:
+                    Constant += Symbols[Name] * self.Labels[Name]
+                    Bases += Symbols[Name]
+                elif Symbols[Name]:
+                    Externs.append(Name)
+            if Bases == 0 and not Externs:
+                Packers[Size].pack_into(self.Program, Offset, Constant & Masks[Size])
+            elif Bases == 1 and not Externs:
+                Label = next(Name for Name in Symbols if Name in self.Labels and Symbols[Name] > 0)
+                Relocs.append((Offset, Size, Label, Constant - self.Labels[Label]))
+            elif Bases == 0 and len(Externs) == 1 and Symbols[Externs[0]] == 1:
+                Relocs.append((Offset, Size, Externs[0], Constant))
+            else:
+                raise AssemblerError("Error: Only a symbol plus a constant can be relocated.", "Only a symbol plus a constant can be relocated.")
+        return Relocs
 
     def ParsePostamble(self):
-        for i in range(len(self.Program)):
-            if (isinstance(self.Program[i], str)):
-                # Found queued label
-                Size = self.Program[i + 1]
-                Label = self.Program[i]
-                if Label not in self.Labels:
-                    print(f"Error: Undefined label {Label}.")
-                    exit(1)
-                self.Program[i:i + Size] = self.Labels[Label].to_bytes(Size, byteorder="little")
-                if Size == 1:
-                    self.Program.pop(i + 1)
-                i += Size
+        if self.Relocatable:
+            self.Fixups = self.Relocations()
+        else:
+            for Offset, Size, Expr, Addend in self.Fixups:
+                Value = self.Labels[Expr] if Expr in self.Labels else self.Evaluate(Expr)
+                Packers[Size].pack_into(self.Program, Offset, (Value + Addend) & Masks[Size])
+        for Name in self.Globals:
+            if Name not in self.Labels:
+                raise AssemblerError(f"Error: Undefined global label {Name}.", f"Undefined global label {Name}.")
+        Segments = self.SegmentLayout()
+        for Prev, Next in zip(Segments, Segments[1:]):
+            if Next[0] < Prev[0] + Prev[3]:
+                Message = f"Segment at 0x{Next[0]:X} overlaps the one at 0x{Prev[0]:X}, which ends at 0x{Prev[0] + Prev[3]:X}."
+                raise AssemblerError(f"Error: {Message}", Message)
+
+    def SegmentLayout(self):
+        # (Address, Start, End, Size) per non-empty segment sorted by address,
+        # its bytes are Program[Start:End] and Size also counts the
+        # reservation that may end the last one
+        Segments = []
+        for i, (Address, Start) in enumerate(self.Segments):
+            End = self.Segments[i + 1][1] if i + 1 < len(self.Segments) else len(self.Program)
+            Size = (self.Segments[i + 1][1] if i + 1 < len(self.Segments) else self.Size()) - Start
+            if Size:
+                Segments.append((Address, Start, End, Size))
+        Segments.sort(key=lambda Segment: Segment[0])
+        return Segments
+
+    def ObjectTables(self):
+        # Every label is written as a symbol so relocations can refer to it,
+        # only labels named by %global are visible to other objects
+        Symbols = []
+        Indexes = {}
+        for Name in self.Labels:
+            Binding = aobj.Global if Name in self.Globals else aobj.Local
+            Indexes[Name] = len(Symbols)
+            Symbols.append(aobj.NewSymbol(Name, Binding, 0, self.Labels[Name]))
+        for Name in sorted(self.Externs - self.Labels.keys()):
+            Indexes[Name] = len(Symbols)
+            Symbols.append(aobj.NewSymbol(Name, aobj.Extern, -1, 0))
+        Relocs = []
+        for Offset, Size, Symbol, Addend in self.Fixups:
+            Relocs.append(aobj.NewReloc(0, Offset, Size, Indexes[Symbol], Addend))
+        Sections = [aobj.NewSection(".text", self.Program, self.Size())]
+        return Sections, Symbols, Relocs
 
     def Parse(self):
-        Token = self.Tokens[0]
-        # Emacs wont recognize the match keyword and just fucks it up. So I will use if statements instead.
+        Stats = self.Stats
+        if Stats is not None:
+            Start = time.perf_counter()
+            Nested = Stats.Phases["Tokenize"] + Stats.Phases["Include"]
+        Token = self.Peek()
         while Token[0] != TokenType.Eof:
             Token = self.Consume()
-            if Token[0] == TokenType.Add:
-                self.HandleOpInst(Token, OpCodes.Add, False)
-            elif Token[0] == TokenType.Sub:
-                self.HandleOpInst(Token, OpCodes.Sub, False)
-            elif Token[0] == TokenType.Mul:
-                self.HandleOpInst(Token, OpCodes.Mul, False)
-            elif Token[0] == TokenType.Div:
-                self.HandleOpInst(Token, OpCodes.Div, False)
-            elif Token[0] == TokenType.Rem:
-                self.HandleOpInst(Token, OpCodes.Rem, False)
-            elif Token[0] == TokenType.Mov:
-                self.HandleOpInst(Token, OpCodes.Mov, False)
-            elif Token[0] == TokenType.Jmp:
-                self.HandleJmp(Token)
-            elif Token[0] == TokenType.Push:
-                self.HandlePush(Token)
-            elif Token[0] == TokenType.Pop:
-                self.HandlePop(Token)
-            elif Token[0] == TokenType.Call:
-                self.HandleCall(Token)
-            elif Token[0] == TokenType.Ret:
-                self.HandleSimpleInst(Token, OpCodes.Ret)
-            elif Token[0] == TokenType.And:
-                self.HandleOpInst(Token, OpCodes.And, False)
-            elif Token[0] == TokenType.Or:
-                self.HandleOpInst(Token, OpCodes.Or, True)
-            elif Token[0] == TokenType.Xor:
-                self.HandleOpInst(Token, OpCodes.Xor, False)
-            elif Token[0] == TokenType.Not:
-                self.HandleNot(Token)
-            elif Token[0] == TokenType.Shl:
-                self.HandleOpInst(Token, OpCodes.Shl, False)
-            elif Token[0] == TokenType.Shr:
-                self.HandleOpInst(Token, OpCodes.Shr, False)
-            elif Token[0] == TokenType.Sei:
-                self.HandleSimpleInst(Token, OpCodes.Sei)
-            elif Token[0] == TokenType.Sdi:
-                self.HandleSimpleInst(Token, OpCodes.Sdi)
-            elif Token[0] == TokenType.Int:
-                self.HandleInt(Token)
-            elif Token[0] == TokenType.Cmp:
-                self.HandleOpInst(Token, OpCodes.Cmp, False)
-            elif Token[0] == TokenType.Define:
-                self.HandleDefine(Token)
-            elif Token[0] == TokenType.Res:
-                self.HandleRes(Token) # Reserve
-            elif Token[0] == TokenType.Org:
-                self.HandleOrg(Token)
+            if Stats is not None:
+                File = self.TokenFile
+                Before = self.Size()
+            Mnemonic = Mnemonics.get(Token[1])
+            if Mnemonic is not None and Mnemonic[0] == Token[0]:
+                Mnemonic[1](self, Token, Mnemonic)
             elif Token[0] == TokenType.PreProc:
                 self.HandlePreProc(Token)
             elif Token[0] == TokenType.Id:
-                if self.Tokens[self.Index + 1][0] == TokenType.Colon:
+                if self.Peek()[0] == TokenType.Colon:
                     self.HandleLabel(Token)
+                elif self.Peek()[0] == TokenType.Equ:
+                    self.Consume()
+                    self.HandleConstant(Token)
                 else:
                     if Token[1].lower() in PrefixKw:
                         self.Error(f"Unexpected Id. Maybe you forgot the size prefix? ({Token[1]}8, {Token[1]}16, {Token[1]}32, {Token[1]}64)")
@@ -619,23 +1649,405 @@ class Parser:
             else:
                 if Token[0] != TokenType.Eof:
                     self.Error("Unexpected statement.")
+            if Stats is not None and Token[0] != TokenType.Eof:
+                Stats.Statement(self, Token, Mnemonic, File, Before)
+        if self.Optimize:
+            self.Peephole()
+        if self.Profile is not None:
+            self.ApplyProfile()
+        if Stats is None:
+            self.ParsePostamble()
+            return
+        # Includes are tokenized while parsing, their time is kept apart
+        Start = Stats.Time("Parse", Start)
+        Stats.Phases["Parse"] -= Stats.Phases["Tokenize"] + Stats.Phases["Include"] - Nested
+        Stats.Fixups = len(self.Fixups)
         self.ParsePostamble()
+        Stats.Time("Postamble", Start)
+        Stats.Finish(self)
+
+CreateKeywords()
+
+def Assemble(Source, IncludePaths=(), Origin=0, FileName=""):
+    # Library entry point: returns the flat image or raises AssemblerError.
+    # Parsers share no mutable state, so this can run on many threads at once.
+    LocalParser = Parser(TokenizeStream(Source), FileName, IncludePaths=IncludePaths)
+    LocalParser.Segments[0] = (Origin, 0)
+    LocalParser.Parse()
+    Segments = LocalParser.SegmentLayout()
+    if len(Segments) < 2:
+        return bytes(LocalParser.Program) + bytes(LocalParser.Reserved)
+    Image = bytearray()
+    for Address, Start, End, Size in Segments:
+        Image += bytes(Address - Segments[0][0] - len(Image))
+        Image += LocalParser.Program[Start:End] + bytes(Size - (End - Start))
+    return bytes(Image)
+
+def FormatError(Err):
+    if Err.File is None:
+        return str(Err)
+    return f"{os.path.relpath(Err.File)}: {Err}"
+
+def ReadSource(Path):
+    # Unreadable and non UTF-8 sources are reported like any other error
+    try:
+        with open(Path, "r") as File:
+            return File.read()
+    except OSError as Err:
+        Message = f"Can't read the file: {Err.strerror}."
+    except UnicodeDecodeError as Err:
+        Message = f"The file isn't UTF-8, {Err.reason} at byte {Err.start}."
+    raise AssemblerError(f"Error: {Message}", Message, os.path.realpath(Path))
+
+def TokenizeFile(Text, Path, Cache=None, Stats=None):
+    # The whole file at once, from the cache when there is one
+    Start = time.perf_counter()
+    Tokens = Cache.Tokenize(Text) if Cache else TokenizeStore(Text)
+    if Stats is not None:
+        Stats.Time("Tokenize", Start)
+        Stats.Tokens(Path, Tokens)
+    return Tokens
+
+def ReadProfile(Name):
+    # Label -> execution count from the JSON report of aemu.py (its
+    # HotLabels), a JSON object of counts or "LABEL COUNT" lines
+    Path = os.path.realpath(Name)
+    try:
+        with open(Name, "r") as File:
+            Text = File.read()
+    except OSError as Err:
+        raise AssemblerError(f"Error: Can't read the profile: {Err.strerror}.", f"Can't read the profile: {Err.strerror}.", Path)
+    try:
+        if Text.lstrip().startswith("{"):
+            Data = json.loads(Text)
+            if "HotLabels" in Data:
+                return {Entry["Label"]: int(Entry["Count"]) for Entry in Data["HotLabels"]}
+            return {Label: int(Count) for Label, Count in Data.items()}
+        Profile = {}
+        for Line in Text.splitlines():
+            Fields = Line.split(";", 1)[0].split()
+            if Fields:
+                Label, Count = Fields
+                Profile[Label] = Profile.get(Label, 0) + int(Count, 0)
+        return Profile
+    except (ValueError, KeyError, TypeError):
+        raise AssemblerError("Error: Expected an aemu.py JSON report, a JSON object of counts or LABEL COUNT lines.",
+                             "Expected an aemu.py JSON report, a JSON object of counts or LABEL COUNT lines.", Path)
+
+def OpenParser(InputName, Object=False, Cache=None, IncludePaths=(), Stats=None, Optimize=0, Prefetch=None, Profile=None):
+    Start = time.perf_counter()
+    Source = ReadSource(InputName)
+    if Prefetch:
+        Prefetch.Scan(Source, os.path.realpath(InputName))
+    if Stats is not None:
+        Stats.Time("Read", Start)
+    try:
+        if Cache is None and Stats is None:
+            Tokens = TokenizeStream(Source)
+        else:
+            Tokens = iter(TokenizeFile(Source, os.path.realpath(InputName), Cache, Stats))
+    except AssemblerError as Err:
+        Err.File = os.path.realpath(InputName)
+        raise
+    LocalParser = Parser(Tokens, InputName, Cache, Object, IncludePaths, Stats, Optimize, ReadProfile(Profile) if Profile else None)
+    LocalParser.Prefetch = Prefetch
+    if Profile:
+        LocalParser.Sources.append(os.path.realpath(Profile)) # Rebuild when the profile changes
+    return LocalParser
+
+def IntelHex(LocalParser):
+    # Data records of up to 16 bytes that never cross a 64 KiB boundary,
+    # each boundary gets an extended linear address record first.
+    # Reservations and the gaps between segments are left out.
+    Lines = []
+    Upper = 0
+    for Address, Start, End, Size in LocalParser.SegmentLayout():
+        if Address + Size > 1 << 32:
+            Message = f"Segment at 0x{Address:X} is beyond the 4 GiB Intel HEX can address."
+            raise AssemblerError(f"Error: {Message}", Message)
+        while Start < End:
+            if Address >> 16 != Upper:
+                Upper = Address >> 16
+                Lines.append(HexRecord(0, 4, Upper.to_bytes(2, byteorder="big")))
+            Length = min(16, End - Start, 0x10000 - (Address & 0xFFFF))
+            Lines.append(HexRecord(Address & 0xFFFF, 0, LocalParser.Program[Start:Start + Length]))
+            Address += Length
+            Start += Length
+    Lines.append(HexRecord(0, 1, b""))
+    return "".join(Lines)
+
+def HexRecord(Address, Type, Data):
+    Record = bytes([len(Data), Address >> 8, Address & 0xFF, Type]) + Data
+    return f":{Record.hex().upper()}{-sum(Record) & 0xFF:02X}\n"
+
+def WriteOutput(LocalParser, OutputName, Object=False):
+    # A flat image unless Object, or Intel HEX when OutputName ends in .hex
+    with open(OutputName, "wb") as Out:
+        if Object:
+            aobj.WriteObject(Out, *LocalParser.ObjectTables())
+        elif OutputName.lower().endswith(".hex"):
+            Out.write(IntelHex(LocalParser).encode())
+        else:
+            # Each segment goes to its offset from the lowest one, gaps
+            # between segments and trailing reservations become holes
+            Segments = LocalParser.SegmentLayout()
+            Length = 0
+            for Address, Start, End, Size in Segments:
+                Out.seek(Address - Segments[0][0])
+                Out.write(memoryview(LocalParser.Program)[Start:End])
+                Length = max(Length, Address - Segments[0][0] + Size)
+            Out.truncate(Length)
+
+def WriteSymbols(LocalParser, Name):
+    # "ADDRESS NAME" per label sorted by address, read by aemu.py
+    with open(Name, "w") as File:
+        for Label, Address in sorted(LocalParser.Labels.items(), key=lambda Item: (Item[1], Item[0])):
+            File.write(f"{Address:016X} {Label}\n")
+
+def LayoutReport(LocalParser):
+    if isinstance(LocalParser.LaidOut, str):
+        return f"Layout: {LocalParser.LaidOut}"
+    Hot, HotBytes, Cold, ColdBytes, Pinned = LocalParser.LaidOut
+    return f"Layout: {Hot} hot blocks ({HotBytes} bytes) first, {Cold} cold blocks ({ColdBytes} bytes) last, {Pinned} blocks pinned"
+
+def OptimizeReport(LocalParser):
+    Instructions = sum(Entry[0] for Rule, Entry in LocalParser.Optimized.items() if Entry[1])
+    Bytes = sum(Entry[1] for Entry in LocalParser.Optimized.values())
+    Rules = ", ".join(f"{Rule} {Entry[0]}" for Rule, Entry in sorted(LocalParser.Optimized.items()))
+    return f"Peephole: removed {Instructions} instructions ({Bytes} bytes){': ' + Rules if Rules else ''}"
+
+def AssembleFile(InputName, OutputName, Object=False, Cache=None, IncludePaths=(), Stats=None, Optimize=0, Prefetch=None, Profile=None):
+    LocalParser = OpenParser(InputName, Object, Cache, IncludePaths, Stats, Optimize, Prefetch, Profile)
+    LocalParser.Parse()
+    Start = time.perf_counter()
+    WriteOutput(LocalParser, OutputName, Object)
+    if Stats is not None:
+        Stats.Time("Write", Start)
+    return LocalParser
+
+def FileStamp(Path):
+    try:
+        Stat = os.stat(Path)
+    except OSError:
+        return None
+    return (Stat.st_mtime_ns, Stat.st_size)
+
+def DepFileName(OutputName):
+    return os.path.splitext(OutputName)[0] + ".d"
+
+def MakeEscape(Path):
+    return Path.replace("$", "$$").replace("#", "\\#").replace(" ", "\\ ")
+
+def WriteDepFile(Name, OutputName, Sources):
+    Deps = [MakeEscape(os.path.relpath(Path)) for Path in Sources]
+    with open(Name, "w") as File:
+        File.write(f"{MakeEscape(OutputName)}: " + " \\\n  ".join(Deps) + "\n")
+        # Empty rules keep make working after an included file is deleted
+        for Dep in Deps[1:]:
+            File.write(f"\n{Dep}:\n")
+
+def BuildKey(Sources, Object, IncludePaths, Optimize=0, Profile=None):
+    # Hash of everything that decides the output: flags and the contents of
+    # every file the last build read. None when one of them is gone.
+    Profile = os.path.realpath(Profile) if Profile else None
+    Hash = hashlib.sha256(f"{Version}\0{Object}\0{Optimize}\0{Profile}\0{[os.path.realpath(Path) for Path in IncludePaths]}".encode())
+    for Path in Sources:
+        try:
+            with open(Path, "rb") as File:
+                Data = File.read()
+        except OSError:
+            return None
+        Hash.update(Path.encode() + b"\0" + hashlib.sha256(Data).digest())
+    return Hash.hexdigest()
+
+def BuildStampName(CacheDir, OutputName):
+    Key = hashlib.sha256(os.path.realpath(OutputName).encode()).hexdigest()
+    return os.path.join(CacheDir, Key + ".build")
+
+def UpToDate(CacheDir, InputName, OutputName, Object, IncludePaths, Optimize=0, Profile=None):
+    # Returns the sources of the previous build when it can be reused as is
+    try:
+        with open(BuildStampName(CacheDir, OutputName), "r") as File:
+            Stamp = json.load(File)
+        Sources = Stamp["Sources"]
+        if not Sources or Sources[0] != os.path.realpath(InputName):
+            return None
+        if FileStamp(OutputName) != tuple(Stamp["Output"]):
+            return None
+        if BuildKey(Sources, Object, IncludePaths, Optimize, Profile) != Stamp["Key"]:
+            return None
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return Sources
+
+def WriteBuildStamp(CacheDir, OutputName, Sources, Object, IncludePaths, Optimize=0, Profile=None):
+    Stamp = {"Key": BuildKey(Sources, Object, IncludePaths, Optimize, Profile),
+             "Sources": Sources,
+             "Output": FileStamp(OutputName)}
+    Name = BuildStampName(CacheDir, OutputName)
+    Temp = f"{Name}.{os.getpid()}"
+    try:
+        with open(Temp, "w") as File:
+            json.dump(Stamp, File)
+        os.replace(Temp, Name)
+    except OSError:
+        pass # The cache is only an optimisation
+
+def BuildFile(InputName, OutputName, Object=False, Cache=None, IncludePaths=(), DepFile=None, Stats=None, Symbols=None, Optimize=0, Prefetch=None, Profile=None):
+    # AssembleFile plus the optional depfile and, with an on-disk cache, the
+    # whole-build cache: when nothing changed the output is left untouched.
+    # Asking for stats or a symbol map always assembles.
+    CacheDir = Cache.Directory if Cache else None
+    Sources = None
+    if CacheDir and Stats is None and Symbols is None:
+        Sources = UpToDate(CacheDir, InputName, OutputName, Object, IncludePaths, Optimize, Profile)
+    if Sources is None:
+        LocalParser = AssembleFile(InputName, OutputName, Object, Cache, IncludePaths, Stats, Optimize, Prefetch, Profile)
+        Sources = LocalParser.Sources
+        if Optimize:
+            print(OptimizeReport(LocalParser))
+        if Profile:
+            print(LayoutReport(LocalParser))
+        if Symbols:
+            WriteSymbols(LocalParser, Symbols)
+        if CacheDir:
+            WriteBuildStamp(CacheDir, OutputName, Sources, Object, IncludePaths, Optimize, Profile)
+    if DepFile:
+        WriteDepFile(DepFile, OutputName, Sources)
+
+def Watch(InputName, OutputName, Object=False, Cache=None, IncludePaths=(), Interval=0.2, Optimize=0, DepFile=None, Symbols=None):
+    # Reassembles whenever a file of the include graph of the last build
+    # changes, or a missing include appears where it was looked for.
+    # Token streams of unchanged files stay resident between builds.
+    if Cache is None:
+        Cache = TokenCache()
+    Cache.Resident = True
+    while True:
+        Start = time.perf_counter()
+        Sources = [os.path.realpath(InputName)]
+        try:
+            LocalParser = OpenParser(InputName, Object, Cache, IncludePaths, Optimize=Optimize)
+            try:
+                LocalParser.Parse()
+            finally:
+                Sources = LocalParser.Sources + LocalParser.Missing
+            WriteOutput(LocalParser, OutputName, Object)
+            if Symbols:
+                WriteSymbols(LocalParser, Symbols)
+            if DepFile:
+                WriteDepFile(DepFile, OutputName, LocalParser.Sources)
+            print(f"Assembled {OutputName} ({LocalParser.Size()} bytes) in {(time.perf_counter() - Start) * 1000:.1f} ms")
+            if Optimize:
+                print(OptimizeReport(LocalParser))
+        except AssemblerError as Err:
+            print(FormatError(Err))
+        except OSError as Err:
+            print(Err)
+        sys.stdout.flush()
+        Cache.Trim()
+        Stamps = {Path: FileStamp(Path) for Path in Sources}
+        while all(FileStamp(Path) == Stamps[Path] for Path in Stamps):
+            time.sleep(Interval)
+
+def AssembleJob(Job):
+    # Runs in a worker process, messages are captured and reported by the caller
+    InputName, OutputName, Object, CacheDir, IncludePaths, DepFile, Optimize = Job
+    Messages = io.StringIO()
+    try:
+        with redirect_stdout(Messages):
+            BuildFile(InputName, OutputName, Object, TokenCache(CacheDir) if CacheDir else None, IncludePaths,
+                      DepFileName(OutputName) if DepFile else None, Optimize=Optimize)
+    except AssemblerError as Err:
+        return (InputName, False, Messages.getvalue() + FormatError(Err) + "\n")
+    except OSError as Err:
+        return (InputName, False, Messages.getvalue() + f"{Err}\n")
+    return (InputName, True, Messages.getvalue())
+
+def ReadManifest(Name):
+    # One "input output" pair per line, blank lines and ';' comments are skipped
+    Jobs = []
+    with open(Name, "r") as Manifest:
+        for LineNo, Line in enumerate(Manifest, 1):
+            Fields = Line.split(";", 1)[0].split()
+            if not Fields:
+                continue
+            if len(Fields) != 2:
+                print(f"Error: {Name}:{LineNo}: Expected an input and an output name.")
+                exit(1)
+            Jobs.append((Fields[0], Fields[1]))
+    return Jobs
+
+def AssembleBatch(Jobs, Workers=None):
+    with ProcessPoolExecutor(Workers) as Pool:
+        return list(Pool.map(AssembleJob, Jobs))
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    ArgParser = argparse.ArgumentParser(prog="aasm", description="Assembler for the astro64 architecture.")
+    ArgParser.add_argument("Input", nargs="?", help="source file to assemble")
+    ArgParser.add_argument("Output", nargs="?", help="output image, Intel HEX when it ends in .hex")
+    ArgParser.add_argument("-c", "--object", action="store_true", help="emit a relocatable object for ald.py instead of a flat image")
+    ArgParser.add_argument("-I", dest="include", action="append", default=[], metavar="DIR", help="search DIR for %%include files")
+    ArgParser.add_argument("--cache-dir", help="reuse token streams and unchanged outputs cached in this directory")
+    ArgParser.add_argument("-MD", dest="depfile", action="store_true", help="write a make dependency file next to the output")
+    ArgParser.add_argument("-MF", dest="depfile_name", metavar="FILE", help="write the make dependency file to FILE")
+    ArgParser.add_argument("--batch", metavar="MANIFEST", help="assemble every input/output pair listed in MANIFEST concurrently")
+    ArgParser.add_argument("-j", "--jobs", type=int, help="worker processes for --batch and --prefetch (default: one per core)")
+    ArgParser.add_argument("--prefetch", action="store_true", help="read and tokenize included files in worker processes ahead of the parser")
+    ArgParser.add_argument("--watch", action="store_true", help="stay running and reassemble when a source file changes")
+    ArgParser.add_argument("--stats", action="store_true", help="print phase timings, memory use and what the output is made of")
+    ArgParser.add_argument("--stats-json", metavar="FILE", help="write the --stats report to FILE as JSON")
+    ArgParser.add_argument("--symbols", metavar="FILE", help="write the address of every label to FILE")
+    ArgParser.add_argument("--profile", metavar="FILE", help="lay out code blocks by the label counts in FILE, hot first and cold last")
+    ArgParser.add_argument("-O", dest="optimize", type=int, choices=[0, 1], default=0, help="-O1 removes instructions without an effect and threads jumps")
+    Args = ArgParser.parse_args()
+    CacheDir = os.path.abspath(Args.cache_dir) if Args.cache_dir else None
+    if (Args.stats or Args.stats_json) and (Args.batch or Args.watch):
+        print("--stats can't be used with --batch or --watch")
+        exit(1)
+    for Option, Given in (("--prefetch", Args.prefetch), ("--profile", Args.profile)):
+        if Given and (Args.batch or Args.watch):
+            print(f"{Option} can't be used with --batch or --watch")
+            exit(1)
+    if Args.batch:
+        if Args.depfile_name:
+            print("-MF can't be used with --batch, use -MD instead")
+            exit(1)
+        Jobs = [(Input, Output, Args.object, CacheDir, Args.include, Args.depfile, Args.optimize) for Input, Output in ReadManifest(Args.batch)]
+        Failed = 0
+        for InputName, Ok, Messages in AssembleBatch(Jobs, Args.jobs):
+            for Line in Messages.splitlines():
+                print(f"{InputName}: {Line}")
+            if not Ok:
+                Failed += 1
+        if Failed:
+            print(f"{Failed} of {len(Jobs)} jobs failed.")
+            exit(1)
+        exit(0)
+    if Args.Input is None:
         print("Expected Input File Name")
         exit(1)
-    if len(sys.argv) < 3:
+    if Args.Output is None:
         print("Expected Output Name")
         exit(1)
-    old_dir = os.getcwd()
-    InputFile = open(sys.argv[1], "r")
-    directory = os.path.dirname(sys.argv[1])
-    os.chdir(directory)
-    CreateKeywords()
-    Tokens = Tokenize(InputFile.read())
-    LocalParser = Parser(Tokens)
-    LocalParser.Parse()
-    os.chdir(old_dir)
-    with open(sys.argv[2], "wb") as Out:
-        Out.write(bytearray(LocalParser.Program))
+    Cache = TokenCache(CacheDir) if CacheDir else None
+    DepFile = Args.depfile_name or (DepFileName(Args.Output) if Args.depfile else None)
+    if Args.watch:
+        try:
+            Watch(Args.Input, Args.Output, Args.object, Cache, Args.include, Optimize=Args.optimize, DepFile=DepFile, Symbols=Args.symbols)
+        except KeyboardInterrupt:
+            exit(0)
+    BuildStats = Stats() if Args.stats or Args.stats_json else None
+    Prefetch = Prefetcher(Args.include, Args.jobs, CacheDir) if Args.prefetch else None
+    try:
+        BuildFile(Args.Input, Args.Output, Args.object, Cache, Args.include, DepFile, BuildStats, Args.symbols, Args.optimize, Prefetch, Args.profile)
+    except AssemblerError as Err:
+        print(FormatError(Err))
+        exit(1)
+    finally:
+        if Prefetch:
+            Prefetch.Close()
+    if Args.stats:
+        print(BuildStats.Text())
+    if Args.stats_json:
+        with open(Args.stats_json, "w") as File:
+            json.dump(BuildStats.Json(), File, indent=2)
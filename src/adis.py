@@ -0,0 +1,359 @@
+import sys
+import re
+import json
+import struct
+import bisect
+import argparse
+import aasm
+import aemu
+
+# Disassembler for the images aasm produces. Everything about an instruction
+# but its operand values follows from the header word, so each header seen is
+# turned once into a table entry with a struct for the operands that follow
+# it. Decoding is then one table lookup and one unpack per instruction.
+#
+# The image is swept from the start. Bytes that don't decode to something the
+# assembler could have written, and instructions that would run over a label,
+# are listed as data. The listing is aasm source that assembles back to the
+# same bytes, which is what --verify checks.
+
+Widths = {1: "B", 2: "H", 4: "I", 8: "Q"}
+NonZero = re.compile(rb"[^\0]")
+Call = aasm.OpCodes.Call.value
+
+# Mnemonic of every header without operand bits, jumps by their condition
+HeaderNames = {}
+JumpNames = {}
+for Name, Mnemonic in aasm.Mnemonics.items():
+    if Mnemonic[2] is None:
+        continue
+    if Mnemonic[2] == aasm.OpCodes.Jmp:
+        JumpNames.setdefault(Mnemonic[5], Name.upper())
+        JumpHeader = Mnemonic[4]
+    else:
+        HeaderNames.setdefault(Mnemonic[4], Name.upper())
+
+def Format(Header):
+    # (Name, Length, Struct, SrcMode, DstMode, Flags, Size, Registers, Modes)
+    # for a header the assembler can write, None for anything else. Modes are
+    # 0 reg, 1 [reg], 2 imm and 3 [abs] for both operands, Registers are the
+    # indexes of the unpacked values that have to be registers.
+    OpCode = (Header >> 8) & 0x3F
+    Layout = aemu.Layouts.get(OpCode)
+    if Layout is None:
+        return None
+    Size = 1 << (Header >> 14)
+    Src = (Header >> 6) & 3
+    Dst = (Header >> 4) & 3
+    Flags = Header & 0xF
+    Fmt = "<"
+    Registers = []
+    Modes = []
+    if Layout == "j":
+        if Header & 0xFF00 != JumpHeader or Header & 0xFF != 2 << 6:
+            return None
+        return (None, 11, struct.Struct("<BQ"), 2, None, 0, 8, (), ("imm",))
+    Name = HeaderNames.get(Header & 0xFF00)
+    if Name is None:
+        return None
+    if "s" not in Layout and (Src or Flags & 0b0101):
+        return None
+    if "d" not in Layout and (Dst or Flags & 0b1010):
+        return None
+    if "s" in Layout:
+        if (Flags & 0b0100 and not Flags & 0b0001) or (Flags & 0b0001 and Src in (0, 2)):
+            return None
+        if OpCode == Call and (Src != 2 or Flags):
+            return None
+        if Flags & 0b0001:
+            if Flags & 0b0100:
+                Registers.append(len(Fmt) - 1)
+            Fmt += "B" if Flags & 0b0100 else "Q"
+        if Src < 2:
+            Registers.append(len(Fmt) - 1)
+        Fmt += "B" if Src < 2 else Widths[Size] if Src == 2 else "Q"
+        Modes.append(aasm.OperandMode(aasm.SrcModes, Src, Flags, 0b0001, 0b0100))
+    else:
+        Src = None
+    if "d" in Layout:
+        if Dst == 3 or (Flags & 0b1000 and not Flags & 0b0010) or (Flags & 0b0010 and Dst == 0):
+            return None
+        if Flags & 0b0010:
+            if Flags & 0b1000:
+                Registers.append(len(Fmt) - 1)
+            Fmt += "B" if Flags & 0b1000 else "Q"
+        if Dst < 2:
+            Registers.append(len(Fmt) - 1)
+        Fmt += "B" if Dst < 2 else "Q"
+        Modes.append(aasm.OperandMode(aasm.DstModes, Dst, Flags, 0b0010, 0b1000))
+        Dst = 3 if Dst == 2 else Dst
+    else:
+        Dst = None
+    Operands = struct.Struct(Fmt)
+    return (Name, 2 + Operands.size, Operands, Src, Dst, Flags, Size, tuple(Registers), tuple(Modes))
+
+Formats = {}
+
+def Sweep(Image, Load=0, Symbols=()):
+    # [(Offset, Length, Entry, Values)], Entry and Values are None for a run of data
+    Stops = sorted({Address - Load for Address, Name in Symbols if Load < Address < Load + len(Image)})
+    Stops.append(len(Image))
+    Items = []
+    Pos = 0
+    Data = None
+    Stop = 0
+    End = len(Image)
+    while Pos < End:
+        while Stops[Stop] <= Pos:
+            Stop += 1
+        Limit = Stops[Stop]
+        Entry = None
+        if Pos + 2 <= Limit:
+            Header = Image[Pos] | Image[Pos + 1] << 8
+            Entry = Formats.get(Header, False)
+            if Entry is False:
+                Entry = Formats[Header] = Format(Header)
+            if Entry is not None and Pos + Entry[1] <= Limit:
+                Values = Entry[2].unpack_from(Image, Pos + 2)
+                if Entry[0] is None:
+                    Valid = Values[0] & ~0b1 in JumpNames
+                else:
+                    Valid = all(Values[i] <= 16 for i in Entry[7])
+                if not Valid:
+                    Entry = None
+            else:
+                Entry = None
+        if Entry is None:
+            if Data is None:
+                Data = Pos
+            Pos += 1
+            if Pos == Limit:
+                Items.append((Data, Pos - Data, None, None))
+                Data = None
+            continue
+        if Data is not None:
+            Items.append((Data, Pos - Data, None, None))
+            Data = None
+        Items.append((Pos, Entry[1], Entry, Values))
+        Pos += Entry[1]
+    return Items
+
+def Number(Value):
+    return str(Value) if Value < 10 else f"0x{Value:X}"
+
+def Operand(Mode, Value, Off, RegOff, Labels):
+    Reg = aemu.RegNames
+    if Mode == 0:
+        return Reg[Value]
+    if Mode == 2:
+        return Labels.get(Value) or Number(Value)
+    Base = Reg[Value] if Mode == 1 else Labels.get(Value) or Number(Value)
+    if Off is None:
+        return f"[{Base}]"
+    if RegOff:
+        return f"[{Base}+{Reg[Off]}]"
+    if Mode == 1 and Off >= 1 << 63:
+        return f"[{Base}-{Number((1 << 64) - Off)}]"
+    return f"[{Base}+{Number(Off)}]"
+
+def Render(Entry, Values, Labels):
+    Name, Length, Operands, Src, Dst, Flags, Size, Registers, Modes = Entry
+    if Name is None:
+        Cond, Target = Values
+        if Cond & 0b1:
+            return f"{JumpNames[Cond & ~0b1]} REL {Number(Target)}"
+        return f"{JumpNames[Cond]} {Labels.get(Target) or Number(Target)}"
+    Texts = []
+    i = 0
+    if Src is not None:
+        Off = None
+        if Flags & 0b0001:
+            Off = Values[i]
+            i += 1
+        # Only full width immediates can be addresses
+        Texts.append(Operand(Src, Values[i], Off, Flags & 0b0100, Labels if Src != 2 or Size == 8 else {}))
+        i += 1
+    if Dst is not None:
+        Off = None
+        if Flags & 0b0010:
+            Off = Values[i]
+            i += 1
+        Texts.insert(0, Operand(Dst, Values[i], Off, Flags & 0b1000, Labels))
+    return f"{Name} {', '.join(Texts)}" if Texts else Name
+
+def DataLines(Data):
+    # D8 lines of up to 16 bytes, long runs of zeros as RES8
+    Lines = []
+    Pos = 0
+    while Pos < len(Data):
+        Match = NonZero.search(Data, Pos)
+        Zeros = (Match.start() if Match else len(Data)) - Pos
+        if Zeros >= 16:
+            Lines.append((Pos, f"RES8 {Zeros}"))
+            Pos += Zeros
+            continue
+        Chunk = Data[Pos:Pos + 16]
+        Lines.append((Pos, "D8 " + ", ".join(Number(Byte) for Byte in Chunk)))
+        Pos += len(Chunk)
+    return Lines
+
+def Listing(Image, Load, Symbols, Items):
+    # aasm source for the image, with the address of every line as a comment
+    Labels = {}
+    for Address, Name in Symbols:
+        Labels.setdefault(Address, Name)
+    Starts = {}
+    for Address, Name in Symbols:
+        Starts.setdefault(Address, []).append(Name)
+    Lines = [f"    ORG 0x{Load:X}"]
+    def Line(Address, Text):
+        for Name in Starts.get(Address, ()):
+            Lines.append(f"{Name}:")
+        Lines.append(f"    {Text:<48}; {Address:08X}")
+    for Offset, Length, Entry, Values in Items:
+        if Entry is None:
+            for Pos, Text in DataLines(Image[Offset:Offset + Length]):
+                Line(Load + Offset + Pos, Text)
+        else:
+            Line(Load + Offset, Render(Entry, Values, Labels))
+    # Labels past the end sit in reservations the image file doesn't hold
+    End = Load + len(Image)
+    for Address in sorted(Address for Address in Starts if Address >= End):
+        if Address > End:
+            Lines.append(f"    RES8 {Address - End}")
+            End = Address
+        Lines += [f"{Name}:" for Name in Starts[Address]]
+    return "\n".join(Lines) + "\n"
+
+def Histograms(Image, Load, Symbols, Items, Top):
+    Mix = {} # Mnemonic: [Count, Bytes]
+    Widths = {}
+    Modes = {}
+    Lengths = {}
+    Regions = {} # Label: [Instructions, Bytes]
+    Code = 0
+    NarrowOffsets = 0
+    Addresses = [Address for Address, Name in Symbols]
+    for Offset, Length, Entry, Values in Items:
+        if Entry is None:
+            continue
+        Code += Length
+        Name = JumpNames[Values[0] & ~0b1] if Entry[0] is None else Entry[0].rstrip("0123456789")
+        Counts = Mix.setdefault(Name, [0, 0])
+        Counts[0] += 1
+        Counts[1] += Length
+        if Entry[0] is not None and Entry[0][-1].isdigit():
+            Widths[Entry[6] * 8] = Widths.get(Entry[6] * 8, 0) + 1
+        for Mode in Entry[8]:
+            Modes[Mode] = Modes.get(Mode, 0) + 1
+        Lengths[Length] = Lengths.get(Length, 0) + 1
+        # An immediate offset always takes 8 bytes
+        Flags = Entry[5]
+        if Flags & 0b0001 and not Flags & 0b0100 and Values[0] < 0x100:
+            NarrowOffsets += 1
+        if Flags & 0b0010 and not Flags & 0b1000 and Values[-2] < 0x100:
+            NarrowOffsets += 1
+        if Symbols:
+            i = bisect.bisect_right(Addresses, Load + Offset) - 1
+            if i >= 0:
+                Counts = Regions.setdefault(Symbols[i][1], [0, 0])
+                Counts[0] += 1
+                Counts[1] += Length
+    Sort = lambda Table: dict(sorted(Table.items(), key=lambda Item: -Item[1][1] if isinstance(Item[1], list) else -Item[1]))
+    return {"Bytes": len(Image),
+            "Load": Load,
+            "Instructions": sum(Lengths.values()),
+            "CodeBytes": Code,
+            "DataBytes": len(Image) - Code,
+            "Mix": {Name: {"Count": Count, "Bytes": Bytes} for Name, (Count, Bytes) in Sort(Mix).items()},
+            "Widths": dict(sorted(Widths.items())),
+            "Modes": Sort(Modes),
+            "Lengths": dict(sorted(Lengths.items())),
+            "NarrowOffsets": NarrowOffsets,
+            "Regions": [{"Label": Name, "Instructions": Count, "Bytes": Bytes}
+                        for Name, (Count, Bytes) in list(Sort(Regions).items())[:Top]]}
+
+def Report(Result):
+    Lines = [f"{Result['Bytes']} bytes at 0x{Result['Load']:X}: {Result['Instructions']} instructions in "
+             f"{Result['CodeBytes']} bytes, {Result['DataBytes']} bytes of data"]
+    Lines.append("Instruction mix:")
+    for Name, Entry in Result["Mix"].items():
+        Lines.append(f"  {Name:<8}{Entry['Count']:10} x{Entry['Bytes']:10} bytes")
+    Lines.append("Operand width:")
+    for Width, Count in Result["Widths"].items():
+        Lines.append(f"  {Width:>2} bits{Count:10}")
+    Lines.append("Addressing modes:")
+    for Mode, Count in Result["Modes"].items():
+        Lines.append(f"  {Mode:<12}{Count:10}")
+    Lines.append("Instruction length:")
+    for Length, Count in Result["Lengths"].items():
+        Lines.append(f"  {Length:>2} bytes{Count:10}")
+    if Result["NarrowOffsets"]:
+        Lines.append(f"Immediate offsets under 256: {Result['NarrowOffsets']} ({Result['NarrowOffsets'] * 7} bytes over a one byte field)")
+    if Result["Regions"]:
+        Lines.append("Largest code regions:")
+        for Entry in Result["Regions"]:
+            Lines.append(f"  {Entry['Label']:<32}{Entry['Instructions']:10} x{Entry['Bytes']:10} bytes")
+    return "\n".join(Lines)
+
+def Verify(Image, Source):
+    # Assembles the listing again, returns None when it gives the same bytes
+    try:
+        Output = aasm.Assemble(Source)
+    except aasm.AssemblerError as Err:
+        return f"the listing doesn't assemble: {Err}"
+    for i in range(min(len(Image), len(Output))):
+        if Image[i] != Output[i]:
+            return f"byte {i} (0x{i:X}) is 0x{Image[i]:02X} in the image and 0x{Output[i]:02X} assembled"
+    if len(Image) != len(Output):
+        return f"the image has {len(Image)} bytes and the listing assembles to {len(Output)}"
+    return None
+
+def Error(Message):
+    print(f"Error: {Message}")
+    exit(1)
+
+if __name__ == "__main__":
+    ArgParser = argparse.ArgumentParser(prog="adis", description="Disassembles astro64 images.")
+    ArgParser.add_argument("Image", nargs="?", help="flat image written by aasm.py or ald.py")
+    ArgParser.add_argument("-o", "--output", metavar="FILE", help="write the listing to FILE instead of standard output")
+    ArgParser.add_argument("--load", type=lambda Value: int(Value, 0), default=0, help="address the image is loaded at")
+    ArgParser.add_argument("--symbols", metavar="FILE", help="label map written by aasm.py --symbols")
+    ArgParser.add_argument("--stats", action="store_true", help="print instruction mix, operand width and code size histograms instead of the listing")
+    ArgParser.add_argument("--json", metavar="FILE", help="write the histograms to FILE as JSON")
+    ArgParser.add_argument("--top", type=int, default=10, help="entries in the largest code region list")
+    ArgParser.add_argument("--verify", action="store_true", help="check that the listing assembles back to the image")
+    Args = ArgParser.parse_args()
+    if Args.Image is None:
+        print("Expected Image File Name")
+        exit(1)
+
+    try:
+        with open(Args.Image, "rb") as File:
+            Image = File.read()
+        Symbols = aemu.ReadSymbols(Args.symbols) if Args.symbols else []
+    except OSError as Err:
+        Error(f"{Err.filename}: {Err.strerror}.")
+    End = Args.load + len(Image)
+    if Symbols and not any(Args.load <= Address <= End for Address, Name in Symbols):
+        Error(f"No label in {Args.symbols} lies inside the image at 0x{Args.load:X}-0x{End:X}, pass the --load address it was assembled for.")
+    Items = Sweep(Image, Args.load, Symbols)
+    if Args.stats or Args.json:
+        Result = Histograms(Image, Args.load, Symbols, Items, Args.top)
+        if Args.stats:
+            print(Report(Result))
+        if Args.json:
+            with open(Args.json, "w") as File:
+                json.dump(Result, File, indent=2)
+    if Args.verify or not Args.stats:
+        Source = Listing(Image, Args.load, Symbols, Items)
+        if Args.output:
+            with open(Args.output, "w") as File:
+                File.write(Source)
+        elif not Args.stats and not Args.verify:
+            sys.stdout.write(Source)
+        if Args.verify:
+            Problem = Verify(Image, Source)
+            if Problem:
+                Error(f"Round trip failed: {Problem}.")
+            print(f"Round trip: {len(Image)} bytes assemble back the same.")
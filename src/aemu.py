@@ -0,0 +1,475 @@
+import json
+import bisect
+import argparse
+import aasm
+
+# Reference emulator for the images aasm produces. It decodes the same
+# layout the assembler writes:
+#
+#   Header:   Size << 14 | OpCode << 8 | Src << 6 | Dst << 4 | Flags
+#   Operands: src offset, src, dst offset, dst. An offset is present when its
+#             flag is set and is one register byte or an 8 byte immediate.
+#   Jumps:    header, condition byte, 8 byte address
+#
+# What the encoding doesn't say is modelled like this: CMP, ADD and SUB set
+# the carry, zero, greater and less bits of FLAGS at the positions the jump
+# condition byte tests them, other ALU operations set zero. Narrow writes to
+# a register keep its upper bits. The stack grows down and PUSH decrements SP
+# before it stores. INT calls the handler in the table IVTBL points to like
+# CALL does. A relative jump adds its operand to the address after the jump.
+
+Carry = 0b00010
+Zero = 0b00100
+Greater = 0b01000
+Less = 0b10000
+Interrupts = 0b100000 # Set by SEI, cleared by SDI
+
+RegIndexes = {"sp": 11, "fp": 12, "ip": 13, "flags": 14, "pgtbl": 15, "ivtbl": 16}
+for i in range(11):
+    RegIndexes[f"g{i}"] = i
+RegNames = {Index: Name.upper() for Name, Index in RegIndexes.items()}
+Sp = RegIndexes["sp"]
+Ip = RegIndexes["ip"]
+Flags = RegIndexes["flags"]
+IvTbl = RegIndexes["ivtbl"]
+
+Masks = {1: 0xFF, 2: 0xFFFF, 4: 0xFFFFFFFF, 8: 0xFFFFFFFFFFFFFFFF}
+
+# Operands of each opcode in encoding order, s is a source, d a destination
+# and j the condition byte and address of a jump
+Layouts = {aasm.OpCodes.Nop: "",
+           aasm.OpCodes.Add: "sd", aasm.OpCodes.Sub: "sd", aasm.OpCodes.Mul: "sd",
+           aasm.OpCodes.Div: "sd", aasm.OpCodes.Rem: "sd", aasm.OpCodes.Mov: "sd",
+           aasm.OpCodes.And: "sd", aasm.OpCodes.Or: "sd", aasm.OpCodes.Xor: "sd",
+           aasm.OpCodes.Shl: "sd", aasm.OpCodes.Shr: "sd", aasm.OpCodes.Cmp: "sd",
+           aasm.OpCodes.Push: "s", aasm.OpCodes.Int: "s", aasm.OpCodes.Call: "s",
+           aasm.OpCodes.Pop: "d", aasm.OpCodes.Not: "d",
+           aasm.OpCodes.Jmp: "j",
+           aasm.OpCodes.Ret: "", aasm.OpCodes.Sei: "", aasm.OpCodes.Sdi: ""}
+Layouts = {OpCode.value: Layouts[OpCode] for OpCode in Layouts}
+OpNames = {OpCode.value: OpCode.name for OpCode in aasm.OpCodes}
+Alu = {aasm.OpCodes.Add.value: lambda A, B: A + B,
+       aasm.OpCodes.Sub.value: lambda A, B: A - B,
+       aasm.OpCodes.Mul.value: lambda A, B: A * B,
+       aasm.OpCodes.Div.value: lambda A, B: A // B,
+       aasm.OpCodes.Rem.value: lambda A, B: A % B,
+       aasm.OpCodes.And.value: lambda A, B: A & B,
+       aasm.OpCodes.Or.value: lambda A, B: A | B,
+       aasm.OpCodes.Xor.value: lambda A, B: A ^ B,
+       aasm.OpCodes.Shl.value: lambda A, B: A << (B & 0x3F),
+       aasm.OpCodes.Shr.value: lambda A, B: A >> (B & 0x3F)}
+
+# Cycles per instruction, on top of Memory for every data access and Taken
+# for every jump, call or return that changes the flow. --costs overrides them.
+DefaultCosts = {"Nop": 1, "Add": 1, "Sub": 1, "Mul": 3, "Div": 20, "Rem": 20,
+                "Mov": 1, "Jmp": 1, "Push": 1, "Pop": 1, "Call": 2, "Ret": 2,
+                "And": 1, "Or": 1, "Xor": 1, "Not": 1, "Shl": 1, "Shr": 1,
+                "Sei": 1, "Sdi": 1, "Int": 4, "Cmp": 1,
+                "Memory": 2, "Taken": 1}
+
+PageBits = 12
+
+class EmulatorError(Exception):
+    pass
+
+def ReadSymbols(Name):
+    # "ADDRESS NAME" lines as written by aasm.py --symbols
+    Symbols = []
+    with open(Name, "r") as File:
+        for Line in File:
+            Fields = Line.split()
+            if len(Fields) == 2:
+                Symbols.append((int(Fields[0], 16), Fields[1]))
+    Symbols.sort()
+    return Symbols
+
+class Machine:
+    def __init__(self, MemorySize, Costs=DefaultCosts):
+        self.Memory = bytearray(MemorySize)
+        self.Regs = [0] * 17
+        self.Costs = [0] * 64
+        for OpCode in OpNames:
+            self.Costs[OpCode] = Costs[OpNames[OpCode]]
+        self.MemoryCost = Costs["Memory"]
+        self.TakenCost = Costs["Taken"]
+        self.Decoded = {} # Address: decoded instruction
+        self.CodeMap = bytearray(MemorySize) # Bytes that belong to a decoded instruction
+        self.Halt = None
+        self.Steps = 0
+        self.Cycles = 0
+        self.OpCounts = [0] * 64
+        self.OpCycles = [0] * 64
+        self.Hot = {} # Address: [Count, Cycles]
+        self.Reads = 0
+        self.Writes = 0
+        self.BytesRead = 0
+        self.BytesWritten = 0
+        self.Pages = {} # Page: [Reads, Writes]
+        self.StackLow = None
+        self.Unhandled = 0 # INTs without a present handler
+
+    def Fault(self, Message):
+        raise EmulatorError(f"{Message} at 0x{self.Regs[Ip]:X}")
+
+    def Load(self, Data, Address):
+        if Address + len(Data) > len(self.Memory):
+            raise EmulatorError(f"Image of {len(Data)} bytes doesn't fit at 0x{Address:X}")
+        self.Memory[Address:Address + len(Data)] = Data
+
+    def Fetch(self, Address, Size):
+        if Address + Size > len(self.Memory):
+            self.Fault("Instruction runs past the end of memory")
+        return int.from_bytes(self.Memory[Address:Address + Size], "little")
+
+    def DecodeOperand(self, Pos, Mode, HasOff, RegOff, Size):
+        Off = None
+        if HasOff:
+            Off = self.Fetch(Pos, 1 if RegOff else 8)
+            Pos += 1 if RegOff else 8
+        if Mode == 0 or Mode == 1:
+            Value = self.Fetch(Pos, 1)
+            Pos += 1
+        elif Mode == 2:
+            Value = self.Fetch(Pos, Size)
+            Pos += Size
+        else:
+            Value = self.Fetch(Pos, 8)
+            Pos += 8
+        if (Mode < 2 and Value > 16) or (RegOff and Off > 16):
+            self.Fault("Invalid register")
+        return (Mode, Value, Off, RegOff), Pos
+
+    def Decode(self, Address):
+        # (OpCode, Bytes, Src, Dst, Cond, Length), operands are
+        # (Mode, Value, Offset, OffsetIsReg) with src modes for both
+        Header = self.Fetch(Address, 2)
+        OpCode = (Header >> 8) & 0x3F
+        Layout = Layouts.get(OpCode)
+        if Layout is None:
+            self.Fault(f"Invalid opcode {OpCode}")
+        Bytes = 1 << (Header >> 14)
+        Pos = Address + 2
+        Src = Dst = None
+        Cond = 0
+        if Layout == "j":
+            Cond = self.Fetch(Pos, 1)
+            Src = (2, self.Fetch(Pos + 1, 8), None, False)
+            Pos += 9
+        if "s" in Layout:
+            Src, Pos = self.DecodeOperand(Pos, (Header >> 6) & 3, Header & 0b0001, Header & 0b0100, Bytes)
+        if "d" in Layout:
+            Mode = (Header >> 4) & 3
+            if Mode == 3:
+                self.Fault("Invalid destination")
+            Dst, Pos = self.DecodeOperand(Pos, 3 if Mode == 2 else Mode, Header & 0b0010, Header & 0b1000, Bytes)
+        Inst = (OpCode, Bytes, Src, Dst, Cond, Pos - Address)
+        self.Decoded[Address] = Inst
+        self.CodeMap[Address:Pos] = b"\x01" * (Pos - Address)
+        return Inst
+
+    def Access(self, Address, Size, Write):
+        if Address + Size > len(self.Memory):
+            self.Fault(f"Memory access at 0x{Address:X} is out of range")
+        Page = self.Pages.get(Address >> PageBits)
+        if Page is None:
+            Page = self.Pages[Address >> PageBits] = [0, 0]
+        Page[Write] += 1
+        if Write:
+            self.Writes += 1
+            self.BytesWritten += Size
+        else:
+            self.Reads += 1
+            self.BytesRead += Size
+
+    def ReadMemory(self, Address, Size):
+        self.Access(Address, Size, 0)
+        return int.from_bytes(self.Memory[Address:Address + Size], "little")
+
+    def WriteMemory(self, Address, Size, Value):
+        self.Access(Address, Size, 1)
+        if any(self.CodeMap[Address:Address + Size]):
+            # Code was overwritten, decode everything again
+            self.Decoded = {}
+            self.CodeMap = bytearray(len(self.Memory))
+        self.Memory[Address:Address + Size] = (Value & Masks[Size]).to_bytes(Size, "little")
+
+    def Address(self, Operand):
+        Mode, Value, Off, RegOff = Operand
+        Address = self.Regs[Value] if Mode == 1 else Value
+        if Off is not None:
+            Address += self.Regs[Off] if RegOff else Off
+        return Address & Masks[8]
+
+    def Read(self, Operand, Size):
+        Mode = Operand[0]
+        if Mode == 0:
+            return self.Regs[Operand[1]] & Masks[Size]
+        elif Mode == 2:
+            return Operand[1]
+        return self.ReadMemory(self.Address(Operand), Size)
+
+    def Write(self, Operand, Size, Value):
+        if Operand[0] == 0:
+            Mask = Masks[Size]
+            Reg = Operand[1]
+            self.Regs[Reg] = (self.Regs[Reg] & ~Mask) | (Value & Mask)
+        else:
+            self.WriteMemory(self.Address(Operand), Size, Value)
+
+    def Push(self, Size, Value):
+        self.Regs[Sp] = (self.Regs[Sp] - Size) & Masks[8]
+        if self.StackLow is None or self.Regs[Sp] < self.StackLow:
+            self.StackLow = self.Regs[Sp]
+        self.WriteMemory(self.Regs[Sp], Size, Value)
+
+    def Pop(self, Size):
+        Value = self.ReadMemory(self.Regs[Sp], Size)
+        self.Regs[Sp] = (self.Regs[Sp] + Size) & Masks[8]
+        return Value
+
+    def SetFlags(self, Mask, Set):
+        # Set holds the bits that are recomputed, the rest of FLAGS is kept
+        self.Regs[Flags] = (self.Regs[Flags] & ~Mask) | Set
+
+    def Step(self):
+        Regs = self.Regs
+        Here = Regs[Ip]
+        Inst = self.Decoded.get(Here)
+        if Inst is None:
+            Inst = self.Decode(Here)
+        OpCode, Size, Src, Dst, Cond, Length = Inst
+        Regs[Ip] = Next = Here + Length
+        Accesses = self.Reads + self.Writes
+        Cost = self.Costs[OpCode]
+        Operation = Alu.get(OpCode)
+        if Operation is not None:
+            A = self.Read(Dst, Size)
+            B = self.Read(Src, Size)
+            if B == 0 and (OpCode == aasm.OpCodes.Div.value or OpCode == aasm.OpCodes.Rem.value):
+                Regs[Ip] = Here
+                self.Fault("Division by zero")
+            Result = Operation(A, B)
+            Mask = Masks[Size]
+            if OpCode == aasm.OpCodes.Add.value or OpCode == aasm.OpCodes.Sub.value:
+                self.SetFlags(Carry | Zero, (Carry if Result != Result & Mask else 0) | (Zero if Result & Mask == 0 else 0))
+            else:
+                self.SetFlags(Zero, Zero if Result & Mask == 0 else 0)
+            self.Write(Dst, Size, Result)
+        elif OpCode == aasm.OpCodes.Mov.value:
+            self.Write(Dst, Size, self.Read(Src, Size))
+        elif OpCode == aasm.OpCodes.Cmp.value:
+            A = self.Read(Dst, Size)
+            B = self.Read(Src, Size)
+            Set = Zero if A == B else (Greater if A > B else Less | Carry)
+            self.SetFlags(Carry | Zero | Greater | Less, Set)
+        elif OpCode == aasm.OpCodes.Jmp.value:
+            Test = Cond & (Carry | Zero | Greater | Less)
+            if Test == 0 or Regs[Flags] & Test:
+                Target = Src[1]
+                if Cond & 1:
+                    Target = (Next + Target) & Masks[8]
+                if Target == Here and Test == 0:
+                    self.Halt = f"Jump to itself at 0x{Here:X}"
+                Regs[Ip] = Target
+                Cost += self.TakenCost
+        elif OpCode == aasm.OpCodes.Call.value:
+            self.Push(8, Next)
+            Regs[Ip] = self.Read(Src, 8)
+            Cost += self.TakenCost
+        elif OpCode == aasm.OpCodes.Ret.value:
+            Regs[Ip] = self.Pop(8)
+            Cost += self.TakenCost
+        elif OpCode == aasm.OpCodes.Push.value:
+            self.Push(Size, self.Read(Src, Size))
+        elif OpCode == aasm.OpCodes.Pop.value:
+            self.Write(Dst, Size, self.Pop(Size))
+        elif OpCode == aasm.OpCodes.Not.value:
+            Result = ~self.Read(Dst, Size) & Masks[Size]
+            self.SetFlags(Zero, Zero if Result == 0 else 0)
+            self.Write(Dst, Size, Result)
+        elif OpCode == aasm.OpCodes.Sei.value:
+            Regs[Flags] |= Interrupts
+        elif OpCode == aasm.OpCodes.Sdi.value:
+            Regs[Flags] &= ~Interrupts
+        elif OpCode == aasm.OpCodes.Int.value:
+            # IVTBL points to (D64 table, D8 count), entries are an 8 byte
+            # address and a flags byte with bit 0 meaning present
+            Vector = self.Read(Src, 1)
+            Table = self.ReadMemory(Regs[IvTbl], 8)
+            Count = self.ReadMemory(Regs[IvTbl] + 8, 1)
+            if Vector < Count and self.ReadMemory(Table + Vector * 9 + 8, 1) & 1:
+                self.Push(8, Next)
+                Regs[Ip] = self.ReadMemory(Table + Vector * 9, 8)
+                Cost += self.TakenCost
+            else:
+                self.Unhandled += 1
+        Cost += (self.Reads + self.Writes - Accesses) * self.MemoryCost
+        self.Steps += 1
+        self.Cycles += Cost
+        self.OpCounts[OpCode] += 1
+        self.OpCycles[OpCode] += Cost
+        Hot = self.Hot.get(Here)
+        if Hot is None:
+            self.Hot[Here] = [1, Cost]
+        else:
+            Hot[0] += 1
+            Hot[1] += Cost
+
+    def Run(self, MaxSteps, Return=None):
+        # Until a jump to itself, a return to the Return address or MaxSteps
+        Regs = self.Regs
+        while self.Halt is None:
+            if Regs[Ip] == Return:
+                self.Halt = "Returned"
+                break
+            if self.Steps >= MaxSteps:
+                self.Halt = f"Stopped after {MaxSteps} instructions"
+                break
+            self.Step()
+        return self.Halt
+
+def Locate(Symbols, Address):
+    # Nearest label at or before Address, as LABEL+OFFSET
+    if not Symbols:
+        return f"0x{Address:X}"
+    i = bisect.bisect_right(Symbols, (Address, "\U0010FFFF")) - 1
+    if i < 0:
+        return f"0x{Address:X}"
+    Base, Name = Symbols[i]
+    return Name if Base == Address else f"{Name}+{Address - Base}"
+
+def Results(Emu, Symbols, Top):
+    ByLabel = {}
+    for Address, (Count, Cycles) in Emu.Hot.items():
+        Label = Locate(Symbols, Address).split("+")[0]
+        Entry = ByLabel.setdefault(Label, [0, 0])
+        Entry[0] += Count
+        Entry[1] += Cycles
+    Hot = sorted(Emu.Hot.items(), key=lambda Item: -Item[1][1])[:Top]
+    Pages = sorted(Emu.Pages.items(), key=lambda Item: -sum(Item[1]))[:Top]
+    return {"Halt": Emu.Halt,
+            "Instructions": Emu.Steps,
+            "Cycles": Emu.Cycles,
+            "Registers": {RegNames[i]: Emu.Regs[i] for i in range(len(Emu.Regs))},
+            "Opcodes": {OpNames[i]: {"Count": Emu.OpCounts[i], "Cycles": Emu.OpCycles[i]} for i in OpNames if Emu.OpCounts[i]},
+            "HotAddresses": [{"Address": Address, "Where": Locate(Symbols, Address), "Count": Count, "Cycles": Cycles}
+                             for Address, (Count, Cycles) in Hot],
+            "HotLabels": [{"Label": Label, "Count": Count, "Cycles": Cycles}
+                          for Label, (Count, Cycles) in sorted(ByLabel.items(), key=lambda Item: -Item[1][1])[:Top]],
+            "Memory": {"Reads": Emu.Reads, "Writes": Emu.Writes,
+                       "BytesRead": Emu.BytesRead, "BytesWritten": Emu.BytesWritten,
+                       "PagesTouched": len(Emu.Pages),
+                       "HotPages": [{"Page": Page << PageBits, "Reads": Reads, "Writes": Writes} for Page, (Reads, Writes) in Pages],
+                       "StackLow": Emu.StackLow},
+            "UnhandledInterrupts": Emu.Unhandled}
+
+def Report(Result):
+    Lines = [f"{Result['Halt']}: {Result['Instructions']} instructions, {Result['Cycles']} cycles"]
+    Lines.append("Registers:")
+    Names = list(Result["Registers"])
+    for i in range(0, len(Names), 4):
+        Lines.append("  " + "  ".join(f"{Name:>5} {Result['Registers'][Name]:016X}" for Name in Names[i:i + 4]))
+    Lines.append("Opcodes:")
+    for Name, Entry in sorted(Result["Opcodes"].items(), key=lambda Item: -Item[1]["Cycles"]):
+        Lines.append(f"  {Name:<8}{Entry['Count']:10} x{Entry['Cycles']:12} cycles")
+    Lines.append("Hot labels:")
+    for Entry in Result["HotLabels"]:
+        Lines.append(f"  {Entry['Label']:<32}{Entry['Count']:10} x{Entry['Cycles']:12} cycles")
+    Lines.append("Hot addresses:")
+    for Entry in Result["HotAddresses"]:
+        Lines.append(f"  {Entry['Address']:08X} {Entry['Where']:<32}{Entry['Count']:10} x{Entry['Cycles']:12} cycles")
+    Memory = Result["Memory"]
+    Lines.append(f"Memory: {Memory['Reads']} reads ({Memory['BytesRead']} bytes), {Memory['Writes']} writes "
+                 f"({Memory['BytesWritten']} bytes), {Memory['PagesTouched']} pages touched")
+    if Memory["StackLow"] is not None:
+        Lines.append(f"Lowest SP: 0x{Memory['StackLow']:X}")
+    for Entry in Memory["HotPages"]:
+        Lines.append(f"  {Entry['Page']:08X}{Entry['Reads']:10} reads{Entry['Writes']:10} writes")
+    if Result["UnhandledInterrupts"]:
+        Lines.append(f"Unhandled interrupts: {Result['UnhandledInterrupts']}")
+    return "\n".join(Lines)
+
+def Error(Message):
+    print(f"Error: {Message}")
+    exit(1)
+
+if __name__ == "__main__":
+    ArgParser = argparse.ArgumentParser(prog="aemu", description="Runs astro64 images and counts cycles.")
+    ArgParser.add_argument("Image", nargs="?", help="flat image written by aasm.py or ald.py")
+    ArgParser.add_argument("--load", default="0", help="address the image is loaded at")
+    ArgParser.add_argument("--entry", help="address or label execution starts at (default: the load address)")
+    ArgParser.add_argument("--call", metavar="LABEL", help="call LABEL with a fresh stack and stop when it returns")
+    ArgParser.add_argument("--symbols", metavar="FILE", help="label map written by aasm.py --symbols")
+    ArgParser.add_argument("--reg", action="append", default=[], metavar="REG=VALUE", help="set a register before running")
+    ArgParser.add_argument("--poke", action="append", default=[], metavar="ADDR=VALUE[:SIZE]", help="store SIZE bytes (default 4) before running")
+    ArgParser.add_argument("--dump", action="append", default=[], metavar="ADDR:LENGTH", help="print LENGTH bytes of memory after running")
+    ArgParser.add_argument("--costs", metavar="FILE", help="JSON file overriding the cycle cost of opcodes, Memory and Taken")
+    ArgParser.add_argument("--memory", type=lambda Value: int(Value, 0), default=0x100000, help="memory size in bytes")
+    ArgParser.add_argument("--max-steps", type=int, default=10_000_000, help="stop after this many instructions")
+    ArgParser.add_argument("--top", type=int, default=10, help="entries in the hot address, label and page lists")
+    ArgParser.add_argument("--json", metavar="FILE", help="write the report to FILE as JSON")
+    Args = ArgParser.parse_args()
+    if Args.Image is None:
+        print("Expected Image File Name")
+        exit(1)
+
+    try:
+        with open(Args.Image, "rb") as File:
+            Image = File.read()
+        Symbols = ReadSymbols(Args.symbols) if Args.symbols else []
+        Costs = dict(DefaultCosts)
+        if Args.costs:
+            with open(Args.costs, "r") as File:
+                for Name, Cost in json.load(File).items():
+                    if Name not in Costs:
+                        Error(f"Unknown cost {Name}, expected one of {', '.join(Costs)}.")
+                    Costs[Name] = Cost
+    except OSError as Err:
+        Error(f"{Err.filename}: {Err.strerror}.")
+    Names = {Name: Address for Address, Name in Symbols}
+    def Value(Text):
+        if Text in Names:
+            return Names[Text]
+        try:
+            return int(Text, 0)
+        except ValueError:
+            Error(f"{Text} is neither a number nor a label{'' if Symbols else ', pass --symbols to use labels'}.")
+
+
+    Emu = Machine(Args.memory, Costs)
+    try:
+        Load = Value(Args.load)
+        Emu.Load(Image, Load)
+        Emu.Regs[Ip] = Value(Args.entry) if Args.entry else Load
+        for Poke in Args.poke:
+            Address, _, Data = Poke.partition("=")
+            Data, _, Size = Data.partition(":")
+            Size = int(Size) if Size else 4
+            Emu.Memory[Value(Address):Value(Address) + Size] = (Value(Data) & Masks[Size]).to_bytes(Size, "little")
+        Return = None
+        if Args.call:
+            Return = len(Emu.Memory) # Never a valid instruction address
+            Emu.Regs[Sp] = len(Emu.Memory)
+            Emu.Regs[Ip] = Value(Args.call)
+            Emu.Push(8, Return)
+        for Reg in Args.reg:
+            Name, _, Data = Reg.partition("=")
+            if Name.lower() not in RegIndexes:
+                Error(f"Unknown register {Name}.")
+            Emu.Regs[RegIndexes[Name.lower()]] = Value(Data) & Masks[8]
+        Emu.Run(Args.max_steps, Return)
+    except EmulatorError as Err:
+        Emu.Halt = f"Error: {Err}"
+    Result = Results(Emu, Symbols, Args.top)
+    print(Report(Result))
+    for Dump in Args.dump:
+        Address, _, Length = Dump.partition(":")
+        Address = Value(Address)
+        Data = Emu.Memory[Address:Address + Value(Length or "16")]
+        for i in range(0, len(Data), 16):
+            print(f"{Address + i:08X}  {Data[i:i + 16].hex(' ')}")
+    if Args.json:
+        with open(Args.json, "w") as File:
+            json.dump(Result, File, indent=2)
+    if Emu.Halt.startswith("Error"):
+        exit(1)
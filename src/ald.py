@@ -1,26 +1,197 @@
 import sys
+import os
+import argparse
+import aobj
+
+ChunkSize = 1 << 20 # Bytes per read/write when the kernel cannot copy for us
+
+def Error(Message):
+    print(f"Error: {Message}")
+    exit(1)
+
+def ParseInput(Spec, Align, Fill):
+    # FILE[,at=OFFSET][,align=N][,fill=BYTE], the options override --align and --fill
+    Settings = {"at": None, "align": Align, "fill": Fill}
+    Parts = Spec.split(",")
+    while len(Parts) > 1 and Parts[-1].partition("=")[0] in Settings:
+        Key, _, Value = Parts.pop().partition("=")
+        try:
+            Settings[Key] = int(Value, 0)
+        except ValueError:
+            Error(f"Invalid {Key} value {Value} for {Spec}.")
+    Name = ",".join(Parts)
+    if Settings["at"] is not None and Settings["at"] < 0:
+        Error(f"Negative offset for {Name}.")
+    if Settings["align"] < 1:
+        Error(f"Alignment of {Name} must be at least 1.")
+    if not 0 <= Settings["fill"] <= 0xFF:
+        Error(f"Fill of {Name} must be a byte.")
+    return (Name, Settings["at"], Settings["align"], Settings["fill"])
+
+def Layout(Inputs, Origin):
+    # Places every input and returns the pieces of the image sorted by offset
+    # as (Offset, Size, Name, Fill, Data, Labels). Raw binaries are only
+    # measured here, their Data is None and they are copied from the file by
+    # Write. Objects are read, placed and have their relocations patched in
+    # Data, Labels lists their sections and globals for the map.
+    Pieces = []
+    Globals = {}
+    Objects = []
+    Cursor = 0
+    for Name, At, Align, Fill in Inputs:
+        try:
+            with open(Name, "rb") as File:
+                Data = File.read(len(aobj.Magic))
+                Data = Data + File.read() if aobj.IsObject(Data) else None
+                Size = os.fstat(File.fileno()).st_size
+        except OSError as Err:
+            Error(f"Cannot read {Name}: {Err.strerror}.")
+        Offset = At if At is not None else -(-Cursor // Align) * Align
+        Labels = []
+        if Data is not None:
+            try:
+                Sections, Symbols, Relocs = aobj.ReadObject(Data)
+            except aobj.ObjectError as Err:
+                Error(f"{Name}: {Err}")
+            Data = bytearray()
+            Bases = []
+            for SectionName, SectionData, SectionSize in Sections:
+                Bases.append(Offset + len(Data))
+                Labels.append((f"section {SectionName}", Origin + Bases[-1]))
+                Data += SectionData
+                Data += bytes(SectionSize - len(SectionData))
+            for SymbolName, Binding, Section, Value in Symbols:
+                if Binding != aobj.Global:
+                    continue
+                if SymbolName in Globals:
+                    Error(f"Symbol {SymbolName} is defined in both {Globals[SymbolName][1]} and {Name}.")
+                Globals[SymbolName] = (Origin + Bases[Section] + Value, Name)
+                Labels.append((SymbolName, Globals[SymbolName][0]))
+            Labels.sort(key=lambda Label: Label[1])
+            Size = len(Data)
+            Objects.append((Name, Data, Offset, Bases, Symbols, Relocs))
+        Pieces.append((Offset, Size, Name, Fill, Data, Labels))
+        Cursor = Offset + Size
+
+    for Name, Data, Offset, Bases, Symbols, Relocs in Objects:
+        for Section, RelocOffset, Size, Symbol, Addend in Relocs:
+            SymbolName, Binding, SymbolSection, Value = Symbols[Symbol]
+            if Binding == aobj.Extern:
+                if SymbolName not in Globals:
+                    Error(f"Undefined symbol {SymbolName} referenced from {Name}.")
+                Address = Globals[SymbolName][0]
+            else:
+                Address = Origin + Bases[SymbolSection] + Value
+            Position = Bases[Section] - Offset + RelocOffset
+            try:
+                Data[Position:Position + Size] = (Address + Addend).to_bytes(Size, byteorder="little")
+            except OverflowError:
+                Error(f"Address of {SymbolName} does not fit in {Size} bytes in {Name}.")
+
+    Pieces.sort(key=lambda Piece: Piece[0])
+    for Prev, Next in zip(Pieces, Pieces[1:]):
+        if Next[0] < Prev[0] + Prev[1]:
+            Error(f"{Next[2]} at 0x{Next[0]:X} overlaps {Prev[2]}, which ends at 0x{Prev[0] + Prev[1]:X}.")
+    return Pieces
+
+def WriteAll(Out, Data):
+    View = memoryview(Data)
+    while View:
+        View = View[os.write(Out, View):]
+
+def Pad(Out, Size, Fill):
+    # Zero padding is left as a hole in the output file
+    if Fill == 0:
+        os.lseek(Out, Size, os.SEEK_CUR)
+        return
+    Chunk = bytes([Fill]) * min(Size, ChunkSize)
+    while Size:
+        WriteAll(Out, Chunk[:Size])
+        Size -= min(Size, len(Chunk))
+
+def Copy(In, Out, Size):
+    # Copies Size bytes at the current positions, in the kernel when the
+    # platform and file systems allow it. Returns the bytes left uncopied.
+    if hasattr(os, "copy_file_range"):
+        try:
+            while Size:
+                Done = os.copy_file_range(In, Out, Size)
+                if not Done:
+                    return Size
+                Size -= Done
+        except OSError:
+            pass
+    if hasattr(os, "sendfile"):
+        try:
+            while Size:
+                Done = os.sendfile(Out, In, None, Size)
+                if not Done:
+                    return Size
+                Size -= Done
+        except OSError:
+            pass
+    while Size:
+        Chunk = os.read(In, min(Size, ChunkSize))
+        if not Chunk:
+            break
+        WriteAll(Out, Chunk)
+        Size -= len(Chunk)
+    return Size
+
+def Write(Pieces, OutName):
+    try:
+        Out = os.open(OutName, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    except OSError as Err:
+        Error(f"Cannot write {OutName}: {Err.strerror}.")
+    Position = 0
+    for Offset, Size, Name, Fill, Data, Labels in Pieces:
+        Pad(Out, Offset - Position, Fill)
+        if Data is not None:
+            WriteAll(Out, Data)
+        else:
+            In = os.open(Name, os.O_RDONLY)
+            Left = Copy(In, Out, Size)
+            os.close(In)
+            if Left:
+                Error(f"{Name} shrank while it was copied.")
+        Position = Offset + Size
+    os.ftruncate(Out, Position) # Sizes the file when it ends with a hole
+    os.close(Out)
+
+def PrintMap(Pieces, Origin, File):
+    print(f"{'Offset':<12}{'Address':<20}{'Size':<12}Input", file=File)
+    Position = 0
+    for Offset, Size, Name, Fill, Data, Labels in Pieces:
+        if Offset > Position:
+            Kind = "(hole)" if Fill == 0 else f"(fill 0x{Fill:02X})"
+            print(f"{Position:<#12x}{Origin + Position:<#20x}{Offset - Position:<#12x}{Kind}", file=File)
+        print(f"{Offset:<#12x}{Origin + Offset:<#20x}{Size:<#12x}{Name}{' (object)' if Data is not None else ''}", file=File)
+        for Label, Address in Labels:
+            print(f"{'':12}{Address:<#20x}{'':12}  {Label}", file=File)
+        Position = Offset + Size
+    print(f"{Position:<#12x}{Origin + Position:<#20x}{'':12}(end)", file=File)
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    ArgParser = argparse.ArgumentParser(prog="ald", description="Links aasm objects and binaries into one image.",
+                                        epilog="Each input may be followed by ,at=OFFSET ,align=N and ,fill=BYTE to place it.")
+    ArgParser.add_argument("Files", nargs="*", metavar="FILE", help="input objects or binaries followed by the output name")
+    ArgParser.add_argument("--org", type=lambda Value: int(Value, 0), default=0, help="address the image is loaded at")
+    ArgParser.add_argument("--align", type=lambda Value: int(Value, 0), default=1, help="default alignment of every input")
+    ArgParser.add_argument("--fill", type=lambda Value: int(Value, 0), default=0, help="default byte between inputs, 0 leaves holes")
+    ArgParser.add_argument("--map", nargs="?", const="-", metavar="FILE", help="print where every input was placed, to FILE if given")
+    Args = ArgParser.parse_intermixed_args()
+    if len(Args.Files) < 1:
         print("Expected Input File Name")
         exit(1)
-    if len(sys.argv) < 3:
+    if len(Args.Files) < 2:
         print("Expected Output Name")
         exit(1)
 
-    Objects = []
-    if len(sys.argv) > 3:
-        for i in range(len(sys.argv) - 2):
-            Objects.append(sys.argv[i + 1])
-    else:
-        Objects.append(sys.argv[1])
-
-    OutName = sys.argv[len(sys.argv) - 1]
-    Out = open(OutName, "wb")
-
-    for InName in Objects:
-        File = open(InName, "rb")
-        Out.write(File.read())
-        File.close()
-
-    Out.close()
+    Inputs = [ParseInput(Spec, Args.align, Args.fill) for Spec in Args.Files[:-1]]
+    Pieces = Layout(Inputs, Args.org)
+    Write(Pieces, Args.Files[-1])
+    if Args.map == "-":
+        PrintMap(Pieces, Args.org, sys.stdout)
+    elif Args.map:
+        with open(Args.map, "w") as File:
+            PrintMap(Pieces, Args.org, File)
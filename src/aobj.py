@@ -0,0 +1,81 @@
+import struct
+
+# Relocatable object format shared by aasm.py and ald.py.
+#
+#   Header:     "AOBJ", version, section count, symbol count, relocation count
+#   Section:    name, data, size (size > len(data) means trailing zeros)
+#   Symbol:     name, binding, section index (-1 when external), value
+#   Relocation: section index, offset, width in bytes, symbol index, addend
+#
+# A relocation is patched with the final address of its symbol plus the addend.
+
+Magic = b"AOBJ"
+ObjVersion = 1
+
+Local = 0
+Global = 1
+Extern = 2
+
+HeaderFmt = struct.Struct("<4sHHII")
+SectionFmt = struct.Struct("<HII")
+SymbolFmt = struct.Struct("<HBiQ")
+RelocFmt = struct.Struct("<HIBIq")
+
+class ObjectError(Exception):
+    pass
+
+def NewSection(Name, Data, Size):
+    return (Name, Data, Size)
+
+def NewSymbol(Name, Binding, Section, Value):
+    return (Name, Binding, Section, Value)
+
+def NewReloc(Section, Offset, Size, Symbol, Addend):
+    return (Section, Offset, Size, Symbol, Addend)
+
+def IsObject(Data):
+    return Data[:len(Magic)] == Magic
+
+def WriteObject(File, Sections, Symbols, Relocs):
+    File.write(HeaderFmt.pack(Magic, ObjVersion, len(Sections), len(Symbols), len(Relocs)))
+    for Name, Data, Size in Sections:
+        Name = Name.encode()
+        File.write(SectionFmt.pack(len(Name), len(Data), Size))
+        File.write(Name)
+        File.write(Data)
+    for Name, Binding, Section, Value in Symbols:
+        Name = Name.encode()
+        File.write(SymbolFmt.pack(len(Name), Binding, Section, Value))
+        File.write(Name)
+    for Reloc in Relocs:
+        File.write(RelocFmt.pack(*Reloc))
+
+def ReadObject(Data):
+    View = memoryview(Data)
+    try:
+        _, Version, SectionCount, SymbolCount, RelocCount = HeaderFmt.unpack_from(View, 0)
+        if Version != ObjVersion:
+            raise ObjectError(f"Unsupported object version {Version}.")
+        Offset = HeaderFmt.size
+        Sections = []
+        for i in range(SectionCount):
+            NameLen, DataLen, Size = SectionFmt.unpack_from(View, Offset)
+            Offset += SectionFmt.size
+            Name = bytes(View[Offset:Offset + NameLen]).decode()
+            Offset += NameLen
+            Sections.append(NewSection(Name, View[Offset:Offset + DataLen], Size))
+            Offset += DataLen
+        Symbols = []
+        for i in range(SymbolCount):
+            NameLen, Binding, Section, Value = SymbolFmt.unpack_from(View, Offset)
+            Offset += SymbolFmt.size
+            Name = bytes(View[Offset:Offset + NameLen]).decode()
+            Offset += NameLen
+            Symbols.append(NewSymbol(Name, Binding, Section, Value))
+        Relocs = []
+        for i in range(RelocCount):
+            Relocs.append(RelocFmt.unpack_from(View, Offset))
+            Offset += RelocFmt.size
+    except (struct.error, UnicodeDecodeError):
+        raise ObjectError("Truncated or corrupt object file.")
+    return Sections, Symbols, Relocs
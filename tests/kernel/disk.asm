@@ -0,0 +1,14 @@
+; Disk controller registers
+DSK_SELECT EQU 0x20000
+DSK_STATUS EQU DSK_SELECT + 4
+DSK_COMMAND EQU DSK_SELECT + 5
+DSK_SECTOR EQU DSK_SELECT + 8
+DSK_COUNT EQU DSK_SELECT + 0x10
+DSK_BUFFER EQU DSK_SELECT + 0x18
+DSK_DISKS EQU DSK_SELECT + 0x20
+
+; Status and command values
+DSK_RDY EQU 1
+DSK_DONE EQU 8
+DSK_READ EQU 1
+DSK_INFO EQU 3
@@ -1,195 +1,15 @@
 KB_MAP_NS:
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 39
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 44
-    D8 45
-    D8 46
-    D8 47
-    D8 48
-    D8 49
-    D8 50
-    D8 51
-    D8 52
-    D8 53
-    D8 54
-    D8 55
-    D8 56
-    D8 57
-    D8 0
-    D8 59
-    D8 0
-    D8 61
-    D8 0
-    D8 0
-    D8 0
-    D8 97
-    D8 98
-    D8 99
-    D8 100
-    D8 101
-    D8 102
-    D8 103
-    D8 104
-    D8 105
-    D8 106
-    D8 107
-    D8 108
-    D8 109
-    D8 110
-    D8 111
-    D8 112
-    D8 113
-    D8 114
-    D8 115
-    D8 116
-    D8 117
-    D8 118
-    D8 119
-    D8 120
-    D8 121
-    D8 122
-    D8 91
-    D8 92
-    D8 93
-    D8 96
-    D8 32
+    D8 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0
+    D8 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0
+    D8 0, 0, 0, 0, 0, 0, 0, 39, 0, 0, 0, 0, 44, 45, 46, 47
+    D8 48, 49, 50, 51, 52, 53, 54, 55, 56, 57, 0, 59, 0, 61, 0, 0
+    D8 0, 97, 98, 99, 100, 101, 102, 103, 104, 105, 106, 107, 108, 109, 110, 111
+    D8 112, 113, 114, 115, 116, 117, 118, 119, 120, 121, 122, 91, 92, 93, 96, 32
 
 KB_MAP_S:
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 34
-    D8 0
-    D8 0
-    D8 0
-    D8 0
-    D8 60
-    D8 95
-    D8 62
-    D8 63
-    D8 41
-    D8 33
-    D8 64
-    D8 35
-    D8 36
-    D8 37
-    D8 34
-    D8 38
-    D8 42
-    D8 40
-    D8 0
-    D8 58
-    D8 0
-    D8 43
-    D8 0
-    D8 0
-    D8 0
-    D8 65
-    D8 66
-    D8 67
-    D8 68
-    D8 69
-    D8 70
-    D8 71
-    D8 72
-    D8 73
-    D8 74
-    D8 75
-    D8 76
-    D8 77
-    D8 78
-    D8 79
-    D8 80
-    D8 81
-    D8 82
-    D8 83
-    D8 84
-    D8 85
-    D8 86
-    D8 87
-    D8 88
-    D8 89
-    D8 90
-    D8 123
-    D8 124
-    D8 125
-    D8 96
-    D8 32
\ No newline at end of file
+    D8 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0
+    D8 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0
+    D8 0, 0, 0, 0, 0, 0, 0, 34, 0, 0, 0, 0, 60, 95, 62, 63
+    D8 41, 33, 64, 35, 36, 37, 34, 38, 42, 40, 0, 58, 0, 43, 0, 0
+    D8 0, 65, 66, 67, 68, 69, 70, 71, 72, 73, 74, 75, 76, 77, 78, 79
+    D8 80, 81, 82, 83, 84, 85, 86, 87, 88, 89, 90, 123, 124, 125, 96, 32
\ No newline at end of file
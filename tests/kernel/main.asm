@@ -22,30 +22,28 @@ PRINT_SHELL_INPUT:
     RET
 
 DSKINFO:
-    MOV64 G0, KB_BUFFER
-    ADD64 G0, 1
+    MOV64 G0, KB_BUFFER + 1
     CALL ATOI
-    CMP32 G1, [0x20020]; DSKCNT
+    CMP32 G1, [DSK_DISKS]
     JGE DSKINFO_EXIT
     MOV32 G10, G1
 
     MOV64 G0, DSKNUM_PROMPT
     CALL PRINT
-    MOV64 G0, KB_BUFFER
-    ADD64 G0, 1
+    MOV64 G0, KB_BUFFER + 1
     MOV8 G1, 0x05
     CALL PRINT_COLOR
     CALL NEWLINE
 
-    MOV32 [0x20000], G10
-    MOV64 [0x20018], DSKBUF
-    MOV8 [0x20005], 3 ; INFO
+    MOV32 [DSK_SELECT], G10
+    MOV64 [DSK_BUFFER], DSKBUF
+    MOV8 [DSK_COMMAND], DSK_INFO
 DSKINFO_LOOP:
-    CMP8 [0x20004], 8 ; DONE
+    CMP8 [DSK_STATUS], DSK_DONE
     JE DSKINFO_DONE
     JMP DSKINFO_LOOP
 DSKINFO_DONE:
-    MOV8 [0x20004], 1 ; RESET STATUS
+    MOV8 [DSK_STATUS], DSK_RDY ; RESET STATUS
 
     MOV64 G0, DSKINFO_NAME
     CALL PRINT
@@ -86,7 +84,7 @@ DSKINFO_EXIT:
     RET
 
 LSDSK:
-    MOV32 G3, [0x20020] ; DSKCNT
+    MOV32 G3, [DSK_DISKS]
     MOV32 G4, 0
 LSDSK_LOOP:
     CMP32 G4, G3
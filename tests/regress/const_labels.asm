@@ -0,0 +1,15 @@
+; Counts computed from labels defined earlier are accepted with -O1 too,
+; and the code they measure keeps its length
+    MOV64 G0, [VALUE]
+    MOV64 [RESULT], G0
+HALT:
+    JMP HALT
+START:
+    MOV64 G1, G1
+END:
+    TIMES END - START D8 0xFF
+    RES8 END - START
+VALUE:
+    D64 END - START
+RESULT:
+    D64 0
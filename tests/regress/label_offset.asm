@@ -0,0 +1,14 @@
+; A jump to a label plus a constant depends on the length of the code it
+; reaches into, -O1 must not remove the PUSH/POP pair after L
+    MOV64 SP, 0x8000
+    MOV64 G0, 1
+    JMP L+6
+L:
+    PUSH64 G1
+    POP64 G1
+    MOV64 G0, 7
+    MOV64 [RESULT], G0
+DONE:
+    JMP DONE
+RESULT:
+    D64 0
@@ -0,0 +1,11 @@
+; -O1 must leave the code a relative jump skips over alone, removing the
+; MOV to itself would make the jump land inside the next instruction
+    MOV64 G0, 1
+    JMP REL 15
+    MOV64 G1, G1
+    MOV64 G0, 2
+    MOV64 [RESULT], G0
+HALT:
+    JMP HALT
+RESULT:
+    D64 0